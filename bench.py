@@ -0,0 +1,343 @@
+import gc
+import os
+import json
+import glob
+import time
+import shutil
+import random
+import platform
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import tracemalloc
+import http.server
+from os import path
+from functools import partial
+from contextlib import redirect_stdout
+
+import numpy as np
+from scipy import sparse
+
+BENCH_PATH = path.join('data', 'bench.json')
+
+HAN_START = 0x4E00
+HAN_SPAN  = 0x9FFF - 0x4E00 + 1
+
+def measure(name, function, repeat=5, **params):
+    """Time `function` over `repeat` runs, then trace the peak memory of one more
+
+    The memory is what Python and numpy allocate during the call, as seen by
+    `tracemalloc`, which is not running while the timings are taken.
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    result = {
+          'name': name
+        , 'params': params
+        , 'repeat': repeat
+        , 'best': min(times)
+        , 'median': statistics.median(times)
+        , 'mean': statistics.mean(times)
+        , 'peak_memory': peak
+    }
+    print('>  {:<32} best {:8.4f}s  median {:8.4f}s  peak {:8.1f}MB'.format(
+        name, result['best'], result['median'], peak / 2**20))
+
+    return result
+
+def quiet(function, *args, **kwargs):
+    """Call a function printing its results, the output being thrown away"""
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        return function(*args, **kwargs)
+
+def synthetic_word(word_id):
+    """Spell a word id with Han characters, the first ids being single characters"""
+    word = ''
+    word_id += 1
+    while word_id:
+        word_id, digit = divmod(word_id - 1, HAN_SPAN)
+        word = chr(HAN_START + digit) + word
+
+    return word
+
+def zipf_cdf(vocabulary_size, exponent=1.1):
+    """The cumulative word frequencies, roughly following Zipf's law like the subtitles do"""
+    weights = 1.0 / np.arange(1, vocabulary_size + 1) ** exponent
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+def synthetic_corpus(n_movies, vocabulary_size=50000, tokens_per_movie=5000, seed=0, chunk_size=1000):
+    """Generate a `Corpus` of `n_movies` movies without writing any file
+
+    The movies have between half and one and a half `tokens_per_movie`
+    words, drawn from a Zipf distribution over `vocabulary_size` words.
+    The counts are built `chunk_size` movies at a time, so that 100k movies
+    only take a few seconds and the memory of the final matrix.
+    """
+    from corpus import Corpus
+
+    rng = np.random.RandomState(seed)
+    cdf = zipf_cdf(vocabulary_size)
+    indices = []
+    data = []
+    indptr = [np.zeros(1, dtype=np.int64)]
+
+    for first in range(0, n_movies, chunk_size):
+        n = min(chunk_size, n_movies - first)
+        lengths = rng.randint(tokens_per_movie // 2, tokens_per_movie * 3 // 2 + 1, n)
+        movies = np.repeat(np.arange(n, dtype=np.int64), lengths)
+        tokens = np.searchsorted(cdf, rng.random_sample(len(movies)))
+
+        keys, counts = np.unique(movies * vocabulary_size + tokens, return_counts=True)
+        indices.append(keys % vocabulary_size)
+        data.append(counts)
+        indptr.append(indptr[-1][-1] + np.cumsum(np.bincount(keys // vocabulary_size, minlength=n)))
+
+    counts = sparse.csr_matrix(
+        (np.concatenate(data), np.concatenate(indices), np.concatenate(indptr)),
+        shape=(n_movies, vocabulary_size))
+    files = ['synthetic_{:06d}.srt'.format(i) for i in range(n_movies)]
+
+    return Corpus(files, [synthetic_word(i) for i in range(vocabulary_size)], counts)
+
+def synthetic_lines(rng, cdf, n_tokens):
+    """Draw the segmented lines of a movie, from 1 to 12 words each"""
+    tokens = np.searchsorted(cdf, rng.random_sample(n_tokens)).tolist()
+    lines = []
+    while tokens:
+        length = rng.randint(1, 13)
+        lines.append(' '.join(synthetic_word(t) for t in tokens[:length]))
+        tokens = tokens[length:]
+
+    return lines
+
+def write_synthetic_movies(root, n_movies, vocabulary_size=50000, tokens_per_movie=5000, seed=0):
+    """Write raw, segmented and crushed subtitles of synthetic movies under `root`
+
+    The raw .srt files have the cue numbers and timings, and the words of a
+    line are not separated, as the segmenter would find them.
+    """
+    from compare import RAW_SUBTITLES_PATH, list_to_dict
+    from corpus import CRUSHED_SUBTITLES_PATH, SEGMENTED_SUBTITLES_PATH
+
+    rng = np.random.RandomState(seed)
+    cdf = zipf_cdf(vocabulary_size)
+    for directory in [RAW_SUBTITLES_PATH, CRUSHED_SUBTITLES_PATH, SEGMENTED_SUBTITLES_PATH, 'tmp']:
+        os.makedirs(path.join(root, directory), exist_ok=True)
+
+    for i in range(n_movies):
+        name = 'synthetic_{:06d}.srt'.format(i)
+        lines = synthetic_lines(rng, cdf, rng.randint(tokens_per_movie // 2, tokens_per_movie * 3 // 2 + 1))
+
+        with open(path.join(root, RAW_SUBTITLES_PATH, name), 'w', encoding='utf8') as out_f:
+            for cue, line in enumerate(lines):
+                seconds = 2 * cue
+                out_f.write('{}\n00:{:02d}:{:02d},000 --> 00:{:02d}:{:02d},500\n{}\n\n'.format(
+                    cue + 1, seconds // 60 % 60, seconds % 60, seconds // 60 % 60, seconds % 60,
+                    line.replace(' ', '')))
+
+        with open(path.join(root, SEGMENTED_SUBTITLES_PATH, name), 'w', encoding='utf8') as out_f:
+            for line in lines:
+                out_f.write(line + '\n')
+
+        with open(path.join(root, CRUSHED_SUBTITLES_PATH, name), 'w', encoding='utf8') as out_f:
+            json.dump(list_to_dict(lines), out_f, ensure_ascii=False)
+
+def write_fixture_page(filename, n_links=2000, seed=0):
+    """Write an index page like the ones `init_db.get_movies_from_index` scraps"""
+    rng = random.Random(seed)
+    with open(filename, 'w', encoding='utf8') as out_f:
+        out_f.write('<html><head><title>Index</title><script>var a = 1;</script></head><body>\n')
+        out_f.write('<div id="header"><a href="/">Home</a>' + '<p>{}</p>'.format('filler ' * 200) * 20 + '</div>\n')
+        out_f.write('<ul>\n')
+        for i in range(n_links):
+            out_f.write('<li><a href="/movie/{0}" title="Movie {0}">{1}</a> ({2})</li>\n'.format(
+                i, synthetic_word(rng.randrange(HAN_SPAN * 4)), rng.randrange(1950, 2020)))
+        out_f.write('</ul>\n<div id="footer">' + '<span>footer</span>' * 500 + '</div></body></html>\n')
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve_directory():
+    """Serve the current directory on a free local port, giving back the server and its url"""
+    server = http.server.HTTPServer(('127.0.0.1', 0), QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(args, root):
+    """Run every benchmark in the scratch directory `root`
+
+    The corpus ranked is either the compiled corpus of the repository or a
+    synthetic one of `args.movies` movies. The files are benchmarked on a
+    sample of `args.sample` synthetic movies, written under `root` along
+    with the users database and a page served locally for the scrapper.
+    """
+    import compare
+    import known_car
+    from corpus import Corpus, WordIndex, load_corpus, load_word_index
+    from store import CorpusStore
+    from scrapper import Scrapper
+
+    data = path.abspath('data')
+    os.chdir(root)
+    os.makedirs('users')
+    write_synthetic_movies('.', args.sample, args.vocabulary, args.tokens, args.seed)
+
+    if args.corpus == 'data':
+        corpus = load_corpus(path.join(data, 'corpus.npz'), path.join(data, 'crushed-subtitles'))
+        segmented_path = path.join(data, 'segmented-subtitles')
+        store = CorpusStore(path.join(data, 'corpus.pack')) if path.isfile(path.join(data, 'corpus.pack')) else None
+        index = load_word_index(corpus, path.join(data, 'word-index.npz'), segmented_path, store)
+        examples_corpus = corpus
+    else:
+        corpus = synthetic_corpus(args.movies, args.vocabulary, args.tokens, args.seed)
+        segmented_path = compare.SEGMENTED_SUBTITLES_PATH
+        examples_corpus = Corpus.from_crushed()
+        store = CorpusStore.from_segmented(segmented_path)
+        index = WordIndex.build(examples_corpus, segmented_path)
+        index.store = store
+
+    described = {
+          'source': args.corpus
+        , 'movies': len(corpus)
+        , 'words': len(corpus.words)
+        , 'tokens': int(corpus.all_count.sum())
+        , 'sample': args.sample
+        , 'seed': args.seed
+    }
+    print('> Corpus: {movies} movies, {words} words, {tokens} tokens'.format(**described))
+
+    frequent = np.argsort(-corpus.counts.sum(axis=0).A1, kind='stable')
+    known = [corpus.words[i] for i in frequent[:args.known].tolist()]
+    known_car.add_user_words('bench', known, source='bench')
+    highlight = examples_corpus.words[int(np.argmax(examples_corpus.counts.sum(axis=0).A1))]
+
+    batches = iter([corpus.words[i] for i in frequent[start:start + 100].tolist()]
+        for start in range(args.known, len(frequent), 100))
+    raw_subtitles = sorted(glob.glob(path.join(compare.RAW_SUBTITLES_PATH, '*.srt')))
+    segmented = []
+    for filename in sorted(glob.glob(path.join(segmented_path, '*')))[:args.sample]:
+        with open(filename, 'r', encoding='utf8', errors='replace') as in_f:
+            segmented.extend(in_f.read().split('\n'))
+
+    write_fixture_page(path.join(root, 'index.html'), args.links, args.seed)
+    server, url = serve_directory()
+
+    repeat = args.repeat
+    results = [
+          measure('get_compatibilities_subtitles', partial(quiet, compare.get_compatibilities_subtitles,
+            'bench', corpus=corpus), repeat, known=args.known)
+        , measure('corpus.compatibilities', partial(corpus.compatibilities, set(known)), repeat, known=args.known)
+        , measure('get_examples', partial(quiet, compare.get_examples, highlight, 'bench',
+            corpus=examples_corpus, index=index), repeat, word=highlight)
+        , measure('list_to_dict', partial(compare.list_to_dict, segmented), repeat, lines=len(segmented))
+        , measure('extract_subtitles', partial(quiet, compare.extract_subtitles, subtitles=raw_subtitles),
+            repeat, files=len(raw_subtitles))
+        , measure('get_user_words', partial(known_car.get_user_words, 'bench'), repeat, known=args.known)
+        , measure('add_user_words', lambda: known_car.add_user_words('bench', next(batches, []), source='bench'),
+            repeat, words=100)
+        , measure('scrapper.html_parser', partial(Scrapper(url + 'index.html', extractors=['ul li a']).page),
+            repeat, links=args.links)
+        , measure('scrapper.fast', partial(Scrapper(url + 'index.html', extractors=['ul li a'],
+            fast=True, parse_only='auto').page), repeat, links=args.links)
+    ]
+    server.shutdown()
+    server.server_close()
+    if store is not None:
+        store.close()
+
+    return described, results
+
+def load_runs(filename=BENCH_PATH):
+    if path.isfile(filename):
+        with open(filename, 'r', encoding='utf8') as in_f:
+            return json.load(in_f)
+
+    return []
+
+def compare_runs(previous, run):
+    """Print how the medians moved since a former run on the same corpus"""
+    former = {result['name']: result for result in previous['results']}
+    print('> Against {} ({})'.format(previous['date'], previous['commit']))
+    for result in run['results']:
+        if result['name'] in former and former[result['name']]['median'] > 0:
+            ratio = result['median'] / former[result['name']]['median']
+            print('>  {:<32} x{:.2f} time  x{:.2f} memory'.format(result['name'], ratio,
+                result['peak_memory'] / max(former[result['name']]['peak_memory'], 1)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the ranking, the examples, the crushing, '
+        'the users store and the scrapper, and record the results')
+    parser.add_argument('--corpus', choices=['data', 'synthetic'], default='synthetic',
+        help='rank the compiled corpus of data/ or a generated one')
+    parser.add_argument('--movies', type=int, default=10000, help='movies of the synthetic corpus')
+    parser.add_argument('--vocabulary', type=int, default=50000, help='words of the synthetic corpus')
+    parser.add_argument('--tokens', type=int, default=5000, help='average words per synthetic movie')
+    parser.add_argument('--sample', type=int, default=200, help='synthetic movies written as files')
+    parser.add_argument('--known', type=int, default=3000, help='most frequent words the user knows')
+    parser.add_argument('--links', type=int, default=2000, help='links of the scrapped page')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default=BENCH_PATH, help='JSON file the runs are appended to')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args(argv)
+
+    output = path.abspath(args.output)
+    cwd = os.getcwd()
+    root = tempfile.mkdtemp(prefix='bench-')
+    try:
+        described, results = run_benchmarks(args, root)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print('> Scratch directory kept in {}'.format(root))
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    run = {
+          'date': time.strftime('%Y-%m-%dT%H:%M:%S')
+        , 'commit': git_commit()
+        , 'python': platform.python_version()
+        , 'platform': platform.platform()
+        , 'corpus': described
+        , 'results': results
+    }
+
+    runs = load_runs(output)
+    previous = [r for r in runs if r['corpus'] == described]
+    if previous:
+        compare_runs(previous[-1], run)
+
+    runs.append(run)
+    os.makedirs(path.dirname(output) or '.', exist_ok=True)
+    with open(output + '.tmp', 'w', encoding='utf8') as out_f:
+        json.dump(runs, out_f, ensure_ascii=False, indent=1)
+    os.replace(output + '.tmp', output)
+    print('> Results appended to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,26 @@ import json
 import io
 import shutil
 import re
+import codecs
+import hashlib
+import argparse
 from os import path
-from subprocess import Popen, PIPE
 
-import pysrt
+import chardet
 
-from known_car import get_user_words
+from known_car import get_user_words, get_users
+from segmenter import get_segmenter, read_lines, segment_documents
+from corpus import CRUSHED_SUBTITLES_PATH, SEGMENTED_SUBTITLES_PATH, Corpus, WordIndex, load_corpus, load_word_index, \
+    simplified_converter
+from fingerprint import SimHashIndex, fingerprint, jaccard, normalize, shingle_hashes, simhash
+from store import load_store
+from similar import update_minhash_index
+import instrument
+from instrument import stage
 
-CRUSHED_SUBTITLES_PATH   = path.join('data', 'crushed-subtitles')
-SEGMENTED_SUBTITLES_PATH = path.join('data', 'segmented-subtitles')
 RAW_SUBTITLES_PATH       = path.join('data', 'subtitles')
+MANIFEST_PATH            = path.join('data', 'manifest.json')
+STORE_COMPACT_FRACTION   = 0.5
 
 def clean(path_file, files_re='*'):
     files = glob.glob(path.join(path_file, files_re))
@@ -23,42 +33,130 @@ def clean(path_file, files_re='*'):
         else:
             shutil.rmtree(f)
 
-def convert_to_utf8(subtitle, current='gbk'):
-    subs = None
-    with open(subtitle, 'rb') as in_f:
-        subs = [line.decode("gbk") for line in in_f.readlines()]
-
-    with open(subtitle, 'w', encoding='utf8') as out_f:
-        for sub in subs:
-            out_f.write(sub)
-
 def sanitize_name(filename):
     path_file, name = path.split(filename)
     name = re.sub(r'[^0-9a-zA-Z _\.]+', '', name)
     return path.join(path_file, name.replace(' ', '_'))
 
-def extract_subtitles(filename_re='*.srt'):
-    print('> Convert subtitles to text files')
-    subtitles = glob.glob(path.join(RAW_SUBTITLES_PATH, filename_re))
+def detect_encoding(sample):
+    """Guess the encoding of a subtitle from its first bytes
+
+    The BOMs are trusted, otherwise UTF-8, the chardet guess and the usual
+    Chinese encodings are tried in turn on the sample, GBK and GB2312 being
+    read as their GB18030 superset and Big5 as Big5-HKSCS. Big5-HKSCS is
+    tried before GB18030, which decodes about any Big5 bytes into mojibake.
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+
+    def guess():
+        encoding = (chardet.detect(sample)['encoding'] or '').lower()
+        supersets = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'big5': 'big5hkscs'}
+        return supersets.get(encoding, encoding)
+
+    for encoding in ['utf-8', guess, 'big5hkscs', 'gb18030']:
+        try:
+            encoding = encoding() if callable(encoding) else encoding
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except (LookupError, UnicodeDecodeError):
+            continue
+
+    return 'gb18030'
 
+def read_subtitle_lines(subtitle, sample_size=1 << 16):
+    """Yield the text lines of the cues of a .srt file
+
+    The encoding is detected once on the beginning of the file, which is
+    then decoded while it is read, the cue numbers and timings being left
+    out. Undecodable bytes are replaced rather than dropping the file.
+    """
+    with open(subtitle, 'rb') as in_f:
+        with stage('compare.detect_encoding') as detecting:
+            encoding = detect_encoding(in_f.read(sample_size))
+            detecting.count(**{encoding: 1})
+        in_f.seek(0)
+
+        in_text = False
+        for line in io.TextIOWrapper(in_f, encoding=encoding, errors='replace'):
+            line = line.rstrip('\n')
+            if '-->' in line and not in_text:
+                in_text = True
+            elif not line.strip():
+                in_text = False
+            elif in_text:
+                yield line
+
+def output_name(subtitle):
+    """Get the name of the files written for a raw subtitle"""
+    return path.split(sanitize_name(subtitle))[1]
+
+def extract_documents(subtitles):
+    """Yield the (output name, text lines) of the raw subtitles, one at a time"""
     for subtitle in subtitles:
-        try:
-            subs = pysrt.open(subtitle)
-        except UnicodeDecodeError:
-            try:
-                convert_to_utf8(subtitle)
-            except UnicodeDecodeError:
-                try:
-                    convert_to_utf8(subtitle, "big5")
-                except UnicodeDecodeError:
-                    continue
-            subs = pysrt.open(subtitle)
-
-        file_name = sanitize_name(path.join('tmp', path.split(subtitle)[1]))
-
-        with open(file_name, 'w') as out_f:
-            for sub in subs:
-                out_f.write(sub.text + '\n')
+        with stage('compare.extract') as extracting:
+            lines = list(read_subtitle_lines(subtitle))
+            extracting.count(files=1, bytes=os.path.getsize(subtitle), lines=len(lines))
+            if not lines:
+                extracting.skip('no text')
+
+        yield output_name(subtitle), lines
+
+def skip_duplicates(subtitles, documents, index, fingerprints, convert=None, max_candidates=3, min_jaccard=0.5):
+    """Pass on the extracted documents which are not near-duplicates of a kept subtitle
+
+    Every document is fingerprinted right after its extraction, before it
+    is segmented. The subtitles of `index` whose SimHash is close are read
+    again, the closest one sharing `min_jaccard` of the shingles of the
+    document being its original: the document is skipped. Other releases
+    of a movie, or its traditional version, are then neither segmented nor
+    counted twice in the rankings. The kept documents join `index`.
+
+    Args:
+        subtitles (list of str): The raw subtitles of `documents`
+
+        documents: The (output name, lines) of the raw subtitles
+
+        index (SimHashIndex): The kept subtitles, by path
+
+        fingerprints (dict): Gets the (fingerprint, original path or None)
+            of every subtitle
+    """
+    convert = convert or simplified_converter()
+    for subtitle, (name, lines) in zip(subtitles, documents):
+        with stage('compare.fingerprint') as fingerprinting:
+            hashes = shingle_hashes(normalize(lines, convert))
+            subtitle_fingerprint = simhash(hashes)
+            original = None
+            for _, candidate in index.candidates(subtitle_fingerprint)[:max_candidates]:
+                if jaccard(hashes, shingle_hashes(normalize(read_subtitle_lines(candidate), convert))) >= min_jaccard:
+                    original = candidate
+                    break
+
+            fingerprinting.count(files=1, shingles=len(hashes))
+            if original is not None:
+                fingerprinting.skip('duplicate')
+
+        fingerprints[subtitle] = (subtitle_fingerprint, original)
+        if original is None:
+            index.add(subtitle, subtitle_fingerprint)
+            yield name, lines
+
+def extract_subtitles(filename_re='*.srt', subtitles=None):
+    print('> Convert subtitles to text files')
+    subtitles = glob.glob(path.join(RAW_SUBTITLES_PATH, filename_re)) if subtitles is None else subtitles
+    extracted = {}
+
+    for subtitle, (name, lines) in zip(subtitles, extract_documents(subtitles)):
+        file_name = path.join('tmp', name)
+        with open(file_name, 'w', encoding='utf8') as out_f:
+            for line in lines:
+                out_f.write(line + '\n')
+        extracted[subtitle] = file_name
+
+    return extracted
 
 def list_to_dict(words):
     result = {}
@@ -69,40 +167,187 @@ def list_to_dict(words):
 
     return result
 
-def segment_subtitles(filename_re='*.srt'):
-    files = glob.glob('../tmp/{}'.format(filename_re))
-    print('> Segment {} files'.format(len(files)))
-    
-    process = Popen(['./segment.sh', ','.join(files)], stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-    segmented_text = stdout.decode('UTF-8').split('\n')
-
-    for file in files:
-        len_file = 0
-        with open(file, 'r') as in_f:
-            len_file = len(in_f.readlines())
-        
-        word_list = segmented_text[:len_file]
-        crushed_file_name   = path.join('..', CRUSHED_SUBTITLES_PATH, path.split(file)[1])
-        segmented_file_name = path.join('..', SEGMENTED_SUBTITLES_PATH, path.split(file)[1])
-        
+def write_document(name, word_list, store):
+    """Write the segmented lines of a document, its word counts and add it to the store"""
+    with stage('compare.write') as writing:
+        store.append(name, word_list)
+
+        crushed_file_name   = path.join(CRUSHED_SUBTITLES_PATH, name)
+        segmented_file_name = path.join(SEGMENTED_SUBTITLES_PATH, name)
+
         with io.open(segmented_file_name, 'w', encoding='utf8') as segmented_file:
             for line in word_list:
                 segmented_file.write(line + '\n')
 
         with io.open(crushed_file_name, 'w', encoding='utf8') as json_file:
             json.dump(list_to_dict(word_list), json_file, ensure_ascii=False)
-            segmented_text = segmented_text[len_file:]
-    
-    # assert len(segmented_text) == 0
-    
-def crush_subtitles():
+
+        writing.count(files=1, bytes=path.getsize(segmented_file_name) + path.getsize(crushed_file_name))
+
+def crush_documents(documents, store):
+    """Segment, count and write (name, lines) documents as they stream in
+
+    The documents are pulled one after the other, a pool of segmenters
+    only keeping a few of them in flight (see `segment_documents`), and each
+    is written as soon as it is segmented. Crushing is then linear in the
+    size of the corpus, with the memory of a few documents.
+    """
+    # The time of the segment stage includes the ones of the stages pulled
+    # through it, extracting and writing the documents
+    with stage('compare.segment') as segmenting:
+        for name, word_list in segment_documents(documents):
+            segmenting.count(files=1, lines=len(word_list), tokens=sum(line.count(' ') + 1 for line in word_list if line))
+            write_document(name, word_list, store)
+
+def segment_subtitles(filename_re='*.srt', files=None, store=None):
+    files = glob.glob(path.join('tmp', filename_re)) if files is None else files
+    store = store or load_store()
+    print('> Segment {} files'.format(len(files)))
+
+    crush_documents(((path.split(file)[1], read_lines(file)) for file in files), store)
+
+def compile_corpus(store=None):
+    print('> Compile the corpus')
+    with stage('compare.compile') as compiling:
+        corpus = Corpus.from_store(store or load_store())
+        corpus.save()
+        WordIndex.build(corpus).save()
+        compiling.count(movies=len(corpus), words=len(corpus.words))
+
+    with stage('compare.minhash') as hashing:
+        update_minhash_index(corpus)
+        hashing.count(movies=len(corpus))
+
+def hash_file(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as in_f:
+        for chunk in iter(lambda: in_f.read(1 << 16), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+def load_manifest():
+    """Get the raw subtitle -> {hash, size, mtime, segmenter, outputs} manifest"""
+    if path.isfile(MANIFEST_PATH):
+        with open(MANIFEST_PATH, 'r', encoding='utf8') as in_f:
+            return json.load(in_f)
+
+    return {}
+
+def save_manifest(manifest):
+    with open(MANIFEST_PATH + '.tmp', 'w', encoding='utf8') as out_f:
+        json.dump(manifest, out_f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(MANIFEST_PATH + '.tmp', MANIFEST_PATH)
+
+def is_crushed(entry, subtitle, segmenter_version):
+    """Check a raw subtitle against its manifest entry
+
+    The file is only hashed when its size or modification time moved.
+    """
+    if not entry or entry['segmenter'] != segmenter_version:
+        return False
+
+    if not all(path.isfile(output) for output in entry['outputs']):
+        return False
+
+    stat = os.stat(subtitle)
+    if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+        return True
+
+    return hash_file(subtitle) == entry['hash']
+
+def crush_subtitles(force=False):
+    """Crush the raw subtitles which changed since the last run
+
+    The manifest keeps the hash of every raw subtitle, the segmenter that
+    crushed it and the files written for it. Only the new or modified
+    subtitles, or the ones crushed by another segmenter, are extracted and
+    segmented again, and the outputs of the removed subtitles are deleted.
+
+    The manifest also keeps the fingerprint of every subtitle, and the
+    near-duplicates of a kept subtitle (see `skip_duplicates`) are linked
+    to it instead of being crushed. They are crushed again once their
+    original changed or was removed.
+
+    The records of the movies crushed again or removed stay in the corpus
+    store until it is compacted, once they take more than
+    `STORE_COMPACT_FRACTION` of it.
+    """
     # clean(CRUSHED_SUBTITLES_PATH)
     # clean(SEGMENTED_SUBTITLES_PATH)
-    clean('tmp')
-    extract_subtitles()
-    segment_subtitles()
-    clean('tmp')
+    manifest = {} if force else load_manifest()
+    segmenter_version = get_segmenter().version
+    subtitles = {path.split(s)[1]: s for s in glob.glob(path.join(RAW_SUBTITLES_PATH, '*.srt'))}
+
+    store = load_store()
+    removed = [name for name in manifest if name not in subtitles]
+    for name in removed:
+        for output in manifest.pop(name)['outputs']:
+            store.delete(path.split(output)[1])
+            if path.isfile(output):
+                os.remove(output)
+
+    with stage('compare.manifest') as checking:
+        changed = {name for name, subtitle in subtitles.items()
+            if not is_crushed(manifest.get(name), subtitle, segmenter_version)}
+        stale = changed.union(removed)
+        changed.update(name for name in subtitles if manifest.get(name, {}).get('duplicate_of') in stale)
+        changed = [subtitles[name] for name in sorted(changed)]
+        checking.count(files=len(subtitles), changed=len(changed), removed=len(removed))
+    print('> {} new or changed subtitles, {} removed'.format(len(changed), len(removed)))
+
+    if changed:
+        # The subtitles kept as they are, fingerprinted now if they were crushed without
+        convert = simplified_converter()
+        index = SimHashIndex()
+        for name, subtitle in sorted(subtitles.items()):
+            entry = manifest.get(name)
+            if subtitle in changed or entry is None or entry.get('duplicate_of'):
+                continue
+            if 'simhash' not in entry:
+                kept_fingerprint = fingerprint(read_subtitle_lines(subtitle), convert)
+                entry['simhash'] = '{:016x}'.format(kept_fingerprint) if kept_fingerprint is not None else None
+            index.add(subtitle, int(entry['simhash'], 16) if entry['simhash'] else None)
+
+        print('> Extract, segment and crush {} subtitles'.format(len(changed)))
+        fingerprints = {}
+        crush_documents(skip_duplicates(changed, extract_documents(changed), index, fingerprints, convert), store)
+
+        duplicates = 0
+        for subtitle in changed:
+            subtitle_fingerprint, original = fingerprints[subtitle]
+            name = output_name(subtitle)
+            outputs = [path.join(CRUSHED_SUBTITLES_PATH, name), path.join(SEGMENTED_SUBTITLES_PATH, name)]
+            if original is not None:
+                outputs = []
+                duplicates += 1
+            for output in manifest.get(path.split(subtitle)[1], {}).get('outputs', []):
+                if output not in outputs:
+                    store.delete(path.split(output)[1])
+                    if path.isfile(output):
+                        os.remove(output)
+
+            manifest[path.split(subtitle)[1]] = {
+                  'hash': hash_file(subtitle)
+                , 'size': os.stat(subtitle).st_size
+                , 'mtime': os.stat(subtitle).st_mtime
+                , 'segmenter': segmenter_version
+                , 'outputs': outputs
+                , 'simhash': '{:016x}'.format(subtitle_fingerprint) if subtitle_fingerprint is not None else None
+                , 'duplicate_of': path.split(original)[1] if original is not None else None
+            }
+        print('> {} near-duplicates skipped'.format(duplicates))
+
+    # Every movie crushed again leaves its former record in the store
+    if store.dead_fraction > STORE_COMPACT_FRACTION:
+        print('> Compact the corpus store')
+        store.compact()
+
+    if changed or removed:
+        compile_corpus(store)
+    save_manifest(manifest)
+    store.close()
+    instrument.snapshot()
 
 def get_compatibility_subtitle(user_words, filename, nb_new=10):
     similar_u_count = 0
@@ -142,11 +387,10 @@ def get_compatibility_subtitle(user_words, filename, nb_new=10):
     else:
         return None
 
-def get_compatibilities_subtitles(user, path_re='*', n=-1):
+def get_compatibilities_subtitles(user, path_re='*', n=-1, corpus=None):
     user_words = get_user_words(user)
-    subtitles = glob.glob(path.join(CRUSHED_SUBTITLES_PATH, path_re))
-    subtitles = [get_compatibility_subtitle(user_words, subtitle) for subtitle in subtitles]
-    subtitles = [sub for sub in subtitles if sub]
+    corpus = corpus or load_corpus()
+    subtitles = corpus.compatibilities(user_words, rows=corpus.select(path_re))
     subtitles = sorted(subtitles, key = lambda x: x['percentage_similar'], reverse=True)
     subtitles = subtitles[:n] if n > 0 else subtitles
 
@@ -154,6 +398,21 @@ def get_compatibilities_subtitles(user, path_re='*', n=-1):
         print('>  {}%:\t{}'.format(subtitle['percentage_similar'], subtitle['name']))
         print(subtitle['top_new_vocabulary'])
 
+    return subtitles
+
+def get_compatibilities_users(users=None, path_re='*', n=-1, corpus=None):
+    users = users or get_users()
+    corpus = corpus or load_corpus()
+    rankings = corpus.batch_compatibilities([get_user_words(user) for user in users], rows=corpus.select(path_re))
+    rankings = {user: (ranking[:n] if n > 0 else ranking) for user, ranking in zip(users, rankings)}
+
+    for user, subtitles in rankings.items():
+        print('> {}'.format(user))
+        for subtitle in subtitles:
+            print('>  {}%:\t{}'.format(subtitle['percentage_similar'], subtitle['name']))
+
+    return rankings
+
 # def higligh_subtitle(subtitle_file, words):
 #     subs = pysrt.open(subtitle_file)
 
@@ -167,39 +426,46 @@ def get_compatibilities_subtitles(user, path_re='*', n=-1):
         
 # # higligh_subtitle('test/Brotherhood.of.Blades.I.srt', ['就'])
 
-def get_examples(highlight_char, user, subtitle_name='*'):
+def get_examples(highlight_char, user, subtitle_name='*', corpus=None, index=None):
     user_words = get_user_words(user)
-    subtitles = glob.glob(path.join(SEGMENTED_SUBTITLES_PATH, subtitle_name))
-
-    for subtitle in subtitles:
-        subs = []
-        try:
-            with open(subtitle, 'r', encoding='utf8') as in_f:
-                subs = in_f.readlines()
-        except UnicodeDecodeError:
-            print('{} is not in utf-8, we could not open it'.format(path.split(subtitle)[1]))
-            continue
-
-        for sub in subs:
-            filtered_sub = ''
-            sub = sub[:-1].split(' ')
-
-            if highlight_char in sub:
-                for char in sub:
-                    if char == highlight_char:
-                        filtered_sub += '\033[0;41m{}\033[0m'.format(char)
-                    elif char in user_words:
-                        filtered_sub += '\033[0;32m{}\033[0m'.format(char)
-                    else:
-                        filtered_sub += char
+    corpus = corpus or load_corpus()
+    index = index or load_word_index(corpus, store=load_store())
+    known = corpus.known_mask(user_words)
+    highlight_id = corpus.vocabulary.get(highlight_char)
+
+    for _, sub in index.examples(highlight_char, subtitle_name):
+        filtered_sub = ''
+        for char in sub.split(' '):
+            char_id = corpus.vocabulary.get(char)
+            if char_id is not None and char_id == highlight_id:
+                filtered_sub += '\033[0;41m{}\033[0m'.format(char)
+            elif char_id is not None and known[char_id]:
+                filtered_sub += '\033[0;32m{}\033[0m'.format(char)
+            else:
+                filtered_sub += char
 
-                    filtered_sub += ' '
-                print(filtered_sub)
+            filtered_sub += ' '
+        print(filtered_sub)
 
 if __name__ == "__main__":
-    # crush_subtitles()
-    get_compatibilities_subtitles('rinku', path_re='Finding_Mr_Right_2013.srt')
-    get_examples('啊', 'rinku', 'Finding_Mr_Right_2013.srt')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', nargs='*', metavar='USER',
+        help='rank the movies for several users at once, all the users if none is given')
+    parser.add_argument('-n', type=int, default=-1, help='number of movies to show per user')
+    parser.add_argument('--path-re', default='*', help='crushed subtitles to rank')
+    parser.add_argument('--metrics', metavar='DIR', default=instrument.INSTRUMENT_PATH,
+        help='record the time and items of every stage in DIR, as JSON lines and a Prometheus textfile')
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrument.enable(args.metrics)
+
+    if args.batch is not None:
+        get_compatibilities_users(args.batch, path_re=args.path_re, n=args.n)
+    else:
+        # crush_subtitles()
+        get_compatibilities_subtitles('rinku', path_re='Finding_Mr_Right_2013.srt')
+        get_examples('啊', 'rinku', 'Finding_Mr_Right_2013.srt')
 
 
 # http://www.singchinesesongs.com/sing.php?singid=350
@@ -0,0 +1,538 @@
+import os
+import glob
+import json
+import mmap
+import array
+import hashlib
+import fnmatch
+from os import path
+
+import numpy as np
+from scipy import sparse
+
+try:
+    import opencc
+except ImportError:
+    opencc = None
+
+CRUSHED_SUBTITLES_PATH   = path.join('data', 'crushed-subtitles')
+SEGMENTED_SUBTITLES_PATH = path.join('data', 'segmented-subtitles')
+CORPUS_PATH              = path.join('data', 'corpus.npz')
+WORD_INDEX_PATH          = path.join('data', 'word-index.npz')
+
+def simplified_converter():
+    """Get a function converting traditional Chinese into simplified Chinese
+
+    Both the OpenCC 1.x bindings and the former `opencc.convert` module are
+    supported, both taking the `t2s.json` configuration. Without OpenCC the
+    text is left as it is.
+    """
+    if opencc is None:
+        return lambda text: text
+
+    if hasattr(opencc, 'OpenCC'):
+        return opencc.OpenCC('t2s.json').convert
+
+    return lambda text: opencc.convert(text, config='t2s.json')
+
+def join_words(words):
+    """Pack words in one newline-joined string, rather than a `<U` array padding every word to the longest"""
+    return np.array('\n'.join(words))
+
+def split_words(packed):
+    """Unpack the words of `join_words`, or of a former array of words"""
+    if packed.ndim:
+        return packed.tolist()
+
+    text = str(packed)
+    return text.split('\n') if text else []
+
+class Corpus:
+    """Movie x word count matrix compiled from the crushed subtitles.
+
+    Every crushed subtitle is a `{word: count}` dict. The corpus gives each
+    word a global id and stacks the dicts into a sparse CSR matrix, one row
+    per movie, so that scoring a user against the whole catalogue is a few
+    vectorized operations instead of a Python loop over every file.
+
+    The ids are the ones of the simplified (canonical) form of the words:
+    們 and 们 are the same word. The traditional forms only live in the
+    variant -> canonical id table, computed once when the corpus is built,
+    so that matching a user never has to convert anything.
+
+    Args:
+        files (list of str): The crushed file names, one per row
+
+        words (list of str): The canonical vocabulary, the index of a word
+            being its id
+
+        counts (scipy.sparse.csr_matrix): The movie x canonical word count
+            matrix
+
+        variants (list of str, optional): The words as found in the subtitles
+
+        canonical (numpy.ndarray, optional): The canonical id of every variant
+    """
+
+    def __init__(self, files, words, counts, variants=None, canonical=None):
+        self.files = list(files)
+        self.words = list(words)
+        self.variants = list(variants) if variants is not None else self.words
+        self.canonical = canonical if canonical is not None else np.arange(len(self.words))
+        self.vocabulary = {word: i for i, word in enumerate(self.words)}
+        self.vocabulary.update(zip(self.variants, self.canonical.tolist()))
+        self.counts = sparse.csr_matrix(counts, dtype=np.int64)
+
+        self.all_count = np.asarray(self.counts.sum(axis=1)).ravel()
+        self.all_u_count = np.diff(self.counts.indptr)
+
+        self.presence = self.counts.copy()
+        self.presence.data[:] = 1
+        self._by_word = None
+        self._signature = None
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def names(self):
+        return ['.'.join(f.split('.')[:-1]) for f in self.files]
+
+    @classmethod
+    def from_crushed(cls, crushed_path=CRUSHED_SUBTITLES_PATH, path_re='*'):
+        """Build the corpus by reading every crushed subtitle once"""
+        filenames = sorted(glob.glob(path.join(crushed_path, path_re)))
+        vocabulary = {}
+        words = []
+        indices = []
+        data = []
+        indptr = [0]
+
+        for filename in filenames:
+            with open(filename, 'r', encoding='utf8') as in_f:
+                chars = json.load(in_f)
+
+            for word, nb in chars.items():
+                word_id = vocabulary.get(word)
+                if word_id is None:
+                    word_id = vocabulary[word] = len(words)
+                    words.append(word)
+                indices.append(word_id)
+                data.append(nb)
+            indptr.append(len(indices))
+
+        counts = sparse.csr_matrix(
+            (np.array(data, dtype=np.int64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+            shape=(len(filenames), len(words)))
+        files = [path.split(f)[1] for f in filenames]
+
+        return cls.from_variants(files, words, counts)
+
+    @classmethod
+    def from_store(cls, store):
+        """Build the corpus from the word counts packed in a `CorpusStore`"""
+        files = store.names
+        indices = []
+        data = []
+        indptr = [0]
+
+        for name in files:
+            word_ids, counts = store.counts(name)
+            indices.append(word_ids)
+            data.append(counts)
+            indptr.append(indptr[-1] + len(word_ids))
+
+        counts = sparse.csr_matrix(
+            (np.concatenate(data or [[]]).astype(np.int64),
+             np.concatenate(indices or [[]]).astype(np.int64),
+             np.array(indptr, dtype=np.int64)),
+            shape=(len(files), len(store.words)))
+
+        return cls.from_variants(files, store.words, counts)
+
+    @classmethod
+    def from_variants(cls, files, variants, variant_counts, convert=None):
+        """Merge the variants of a same word into its canonical form"""
+        convert = convert or simplified_converter()
+        forms = convert('\n'.join(variants)).split('\n')
+        if len(forms) != len(variants):
+            forms = [convert(variant) for variant in variants]
+
+        vocabulary = {}
+        words = []
+        canonical = np.empty(len(variants), dtype=np.int64)
+        for i, form in enumerate(forms):
+            word_id = vocabulary.get(form)
+            if word_id is None:
+                word_id = vocabulary[form] = len(words)
+                words.append(form)
+            canonical[i] = word_id
+
+        projection = sparse.csr_matrix(
+            (np.ones(len(variants), dtype=np.int64), canonical, np.arange(len(variants) + 1)),
+            shape=(len(variants), len(words)))
+        counts = sparse.csr_matrix(variant_counts @ projection)
+        counts.sort_indices()
+
+        return cls(files, words, counts, variants, canonical)
+
+    def save(self, filename=CORPUS_PATH):
+        # Written aside and moved, the server never reading a partial file
+        tmp_file = filename + '.tmp.npz'
+        np.savez(tmp_file,
+            files=np.array(self.files, dtype=str),
+            words=join_words(self.words),
+            variants=join_words(self.variants),
+            canonical=self.canonical,
+            data=self.counts.data,
+            indices=self.counts.indices,
+            indptr=self.counts.indptr,
+            shape=np.array(self.counts.shape))
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, filename=CORPUS_PATH):
+        with np.load(filename, allow_pickle=False) as archive:
+            counts = sparse.csr_matrix(
+                (archive['data'], archive['indices'], archive['indptr']),
+                shape=tuple(archive['shape']))
+            return cls(archive['files'].tolist(), split_words(archive['words']), counts,
+                split_words(archive['variants']), archive['canonical'])
+
+    @property
+    def signature(self):
+        """A digest of the movies, the vocabulary and the counts, telling two builds apart
+
+        The word ids and the counts are hashed along the names, a movie crushed
+        again giving another signature even with as many distinct words.
+        """
+        if self._signature is None:
+            digest = hashlib.sha1('\n'.join(self.files).encode('utf8'))
+            digest.update('\n'.join(self.words).encode('utf8'))
+            digest.update('{}'.format(self.counts.shape).encode('utf8'))
+            for values in (self.counts.indptr, self.counts.indices, self.counts.data):
+                digest.update(np.ascontiguousarray(values, dtype=np.int64).tobytes())
+            self._signature = digest.hexdigest()
+
+        return self._signature
+
+    @property
+    def by_word(self):
+        """The counts as a CSC matrix, giving the movies of a word"""
+        if self._by_word is None:
+            self._by_word = self.counts.tocsc()
+
+        return self._by_word
+
+    @property
+    def document_frequency(self):
+        """The number of movies every word is found in"""
+        return np.bincount(self.counts.indices, minlength=len(self.words))
+
+    @property
+    def token_frequency(self):
+        """The number of occurrences of every word in the whole corpus"""
+        return np.bincount(self.counts.indices, weights=self.counts.data, minlength=len(self.words)).astype(np.int64)
+
+    def find(self, name):
+        """Get the row of a movie from its file name, with or without extension"""
+        for i, (f, n) in enumerate(zip(self.files, self.names)):
+            if name in (f, n):
+                return i
+
+        raise KeyError('No movie named `{}` in the corpus'.format(name))
+
+    def select(self, path_re='*'):
+        """Get the rows of the movies whose file name matches `path_re`"""
+        if path_re == '*':
+            return np.arange(len(self.files))
+
+        return np.array([i for i, f in enumerate(self.files) if fnmatch.fnmatch(f, path_re)], dtype=np.int64)
+
+    def known_mask(self, user_words):
+        """Turn a set of words into a boolean mask over the canonical vocabulary"""
+        mask = np.zeros(len(self.words), dtype=bool)
+        ids = [self.vocabulary[word] for word in user_words if word in self.vocabulary]
+        mask[ids] = True
+
+        return mask
+
+    def known_matrix(self, users_words):
+        """Turn several sets of words into a sparse user x word matrix"""
+        indices = []
+        indptr = [0]
+        for user_words in users_words:
+            # Several variants of a word the user knows have the same id
+            ids = np.unique([self.vocabulary[word] for word in user_words if word in self.vocabulary]).astype(np.int64)
+            indices.extend(ids.tolist())
+            indptr.append(len(indices))
+
+        return sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+            shape=(len(indptr) - 1, len(self.words)))
+
+    def similar_counts(self, mask):
+        """Get the known token and known unique word counts of every movie"""
+        known = mask.astype(np.int64)
+        similar_count = self.counts @ known
+        similar_u_count = self.presence @ known
+
+        return similar_count, similar_u_count
+
+    def top_unknown(self, mask, n=10):
+        """Get the `n` most frequent unknown words of every movie
+
+        Ties are kept in the order of the word ids.
+        """
+        unknown = ~mask[self.counts.indices]
+        rows = np.repeat(np.arange(len(self.files)), self.all_u_count)[unknown]
+        cols = self.counts.indices[unknown]
+        data = self.counts.data[unknown]
+
+        order = np.lexsort((-data, rows))
+        rows, cols, data = rows[order], cols[order], data[order]
+
+        nb_unknown = np.bincount(rows, minlength=len(self.files))
+        starts = np.cumsum(nb_unknown) - nb_unknown
+        keep = np.arange(len(rows)) - starts[rows] < n
+        cols, data = cols[keep], data[keep]
+
+        bounds = np.cumsum(np.minimum(nb_unknown, n))[:-1]
+        return [[(self.words[c], int(d)) for c, d in zip(c_row, d_row)]
+            for c_row, d_row in zip(np.split(cols, bounds), np.split(data, bounds))]
+
+    def compatibilities(self, user_words, rows=None, nb_new=10):
+        """Score every movie against a user vocabulary
+
+        The result has the same shape as `compare.get_compatibility_subtitle`,
+        movies without any word being left out.
+        """
+        mask = self.known_mask(user_words)
+        rows = np.arange(len(self.files)) if rows is None else rows
+
+        similar_count, similar_u_count = self.similar_counts(mask)
+        top_new_vocabulary = self.top_unknown(mask, nb_new)
+        names = self.names
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentage_similar = (similar_count / self.all_count * 100)
+            percentage_u_similar = (similar_u_count / self.all_u_count * 100)
+
+        return [{
+              'name': names[i]
+            , 'top_new_vocabulary': top_new_vocabulary[i]
+            , 'all_count': int(self.all_count[i])
+            , 'similar_count': int(similar_count[i])
+            , 'percentage_similar': int(percentage_similar[i])
+            , 'all_u_count': int(self.all_u_count[i])
+            , 'similar_u_count': int(similar_u_count[i])
+            , 'percentage_u_similar': int(percentage_u_similar[i])
+        } for i in rows if self.all_count[i] > 0]
+
+    def batch_compatibilities(self, users_words, rows=None, nb_new=0):
+        """Score several users against every movie in one pass
+
+        The known words of all the users are stacked in a user x word matrix
+        which is multiplied by the word x movie matrix, so the cost follows
+        the size of the matrices rather than the number of users.
+
+        Returns:
+            A list with, for each user, the scores of `compatibilities` ranked
+            by `percentage_similar`. The top new vocabulary is only computed
+            when `nb_new` is given as it needs one pass per user.
+        """
+        rows = np.arange(len(self.files)) if rows is None else np.asarray(rows)
+        rows = rows[self.all_count[rows] > 0]
+        known = self.known_matrix(users_words)
+
+        similar_count = (known @ self.counts[rows].T).toarray()
+        similar_u_count = (known @ self.presence[rows].T).toarray()
+        percentage_similar = (similar_count / self.all_count[rows] * 100).astype(np.int64)
+        percentage_u_similar = (similar_u_count / self.all_u_count[rows] * 100).astype(np.int64)
+        ranks = np.argsort(-percentage_similar, axis=1, kind='stable')
+        names = self.names
+
+        results = []
+        for u, user_words in enumerate(users_words):
+            top_new_vocabulary = self.top_unknown(self.known_mask(user_words), nb_new) if nb_new > 0 else None
+            results.append([{
+                  'name': names[rows[j]]
+                , 'top_new_vocabulary': top_new_vocabulary[rows[j]] if top_new_vocabulary else []
+                , 'all_count': int(self.all_count[rows[j]])
+                , 'similar_count': int(similar_count[u, j])
+                , 'percentage_similar': int(percentage_similar[u, j])
+                , 'all_u_count': int(self.all_u_count[rows[j]])
+                , 'similar_u_count': int(similar_u_count[u, j])
+                , 'percentage_u_similar': int(percentage_u_similar[u, j])
+            } for j in ranks[u]])
+
+        return results
+
+def newest_mtime(source):
+    """Get the modification time of a file, or of the newest file of a directory
+
+    A file written over in place leaves the time of its directory as it is,
+    which only moves when files are added or removed.
+    """
+    mtime = path.getmtime(source)
+    if path.isdir(source):
+        for entry in os.scandir(source):
+            mtime = max(mtime, entry.stat().st_mtime)
+
+    return mtime
+
+def is_fresh(filename, *sources):
+    """Check that a compiled file is newer than all the existing `sources`"""
+    if not path.isfile(filename):
+        return False
+
+    mtime = path.getmtime(filename)
+    return all(newest_mtime(source) <= mtime for source in sources if path.exists(source))
+
+def load_corpus(filename=CORPUS_PATH, crushed_path=CRUSHED_SUBTITLES_PATH):
+    """Load the compiled corpus, building it again if the crushed files changed"""
+    if is_fresh(filename, crushed_path):
+        try:
+            return Corpus.load(filename)
+        except KeyError:
+            pass
+
+    corpus = Corpus.from_crushed(crushed_path)
+    corpus.save(filename)
+
+    return corpus
+
+class WordIndex:
+    """Inverted index from the corpus words to the segmented subtitle lines.
+
+    The postings of a word are the (movie, line number, byte offset) of every
+    line containing it under any of its variants, stored word after word
+    like the rows of a CSR matrix. Looking up a word seeks straight to its
+    lines in the memory-mapped segmented subtitles instead of reading the
+    whole segmented corpus, or in the `CorpusStore` when there is one.
+
+    Args:
+        files (list of str): The segmented file names, the movie ids
+            being their indexes
+
+        vocabulary (dict): The word -> id mapping of the `Corpus`
+
+        indptr (numpy.ndarray): Start of the postings of each word id
+
+        movies, lines, offsets (numpy.ndarray): The postings
+
+        segmented_path (str): Where the segmented subtitles are
+
+        store (CorpusStore, optional): The packed segmented subtitles, read
+            rather than the segmented files for the movies it holds
+    """
+
+    def __init__(self, files, vocabulary, indptr, movies, lines, offsets, segmented_path=SEGMENTED_SUBTITLES_PATH, store=None):
+        self.files = list(files)
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.movies = movies
+        self.lines = lines
+        self.offsets = offsets
+        self.segmented_path = segmented_path
+        self.store = store
+        self._maps = {}
+
+    @classmethod
+    def build(cls, corpus, segmented_path=SEGMENTED_SUBTITLES_PATH):
+        """Index the segmented subtitles of the movies of `corpus`"""
+        word_ids = array.array('i')
+        movies = array.array('i')
+        lines = array.array('i')
+        offsets = array.array('i')
+
+        for movie, file_name in enumerate(corpus.files):
+            try:
+                with open(path.join(segmented_path, file_name), 'rb') as in_f:
+                    content = in_f.read().decode('utf8')
+            except (IOError, UnicodeDecodeError):
+                print('{} could not be indexed'.format(file_name))
+                continue
+
+            offset = 0
+            content = content[:-1] if content.endswith('\n') else content
+            for line_number, line in enumerate(content.split('\n')):
+                ids = {corpus.vocabulary.get(word) for word in line.split(' ')}
+                ids.discard(None)
+                word_ids.extend(ids)
+                movies.extend([movie] * len(ids))
+                lines.extend([line_number] * len(ids))
+                offsets.extend([offset] * len(ids))
+                offset += len(line.encode('utf8')) + 1
+
+        word_ids = np.frombuffer(word_ids, dtype=np.int32)
+        order = np.argsort(word_ids, kind='stable')
+        indptr = np.zeros(len(corpus.words) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(word_ids, minlength=len(corpus.words)), out=indptr[1:])
+
+        return cls(corpus.files, corpus.vocabulary, indptr,
+            np.frombuffer(movies, dtype=np.int32)[order],
+            np.frombuffer(lines, dtype=np.int32)[order],
+            np.frombuffer(offsets, dtype=np.int32)[order],
+            segmented_path)
+
+    def save(self, filename=WORD_INDEX_PATH):
+        tmp_file = filename + '.tmp.npz'
+        np.savez(tmp_file,
+            files=np.array(self.files, dtype=str),
+            indptr=self.indptr,
+            movies=self.movies,
+            lines=self.lines,
+            offsets=self.offsets)
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, corpus, filename=WORD_INDEX_PATH, segmented_path=SEGMENTED_SUBTITLES_PATH, store=None):
+        with np.load(filename, allow_pickle=False) as archive:
+            return cls(archive['files'].tolist(), corpus.vocabulary, archive['indptr'],
+                archive['movies'], archive['lines'], archive['offsets'], segmented_path, store)
+
+    def postings(self, word):
+        """Get the (movie, line number, byte offset) arrays of a word"""
+        word_id = self.vocabulary.get(word)
+        if word_id is None:
+            empty = np.zeros(0, dtype=np.int32)
+            return empty, empty, empty
+
+        start, end = self.indptr[word_id], self.indptr[word_id + 1]
+        return self.movies[start:end], self.lines[start:end], self.offsets[start:end]
+
+    def _map(self, movie):
+        if movie not in self._maps:
+            with open(path.join(self.segmented_path, self.files[movie]), 'rb') as in_f:
+                self._maps[movie] = mmap.mmap(in_f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._maps[movie]
+
+    def line(self, movie, offset):
+        """Read the segmented line starting at `offset` in a movie"""
+        segmented = self._map(movie)
+        end = segmented.find(b'\n', offset)
+        return segmented[offset:end if end >= 0 else len(segmented)].decode('utf8')
+
+    def examples(self, word, path_re='*'):
+        """Yield the (file name, line) of every line containing `word`"""
+        movies, lines, offsets = self.postings(word)
+        for movie, line, offset in zip(movies.tolist(), lines.tolist(), offsets.tolist()):
+            file_name = self.files[movie]
+            if path_re == '*' or fnmatch.fnmatch(file_name, path_re):
+                if self.store is not None and file_name in self.store:
+                    yield file_name, self.store.line(file_name, line)
+                else:
+                    yield file_name, self.line(movie, offset)
+
+def load_word_index(corpus, filename=WORD_INDEX_PATH, segmented_path=SEGMENTED_SUBTITLES_PATH, store=None):
+    """Load the word index, building it again if the segmented files changed"""
+    if is_fresh(filename, segmented_path, CORPUS_PATH):
+        return WordIndex.load(corpus, filename, segmented_path, store)
+
+    index = WordIndex.build(corpus, segmented_path)
+    index.store = store
+    index.save(filename)
+
+    return index
@@ -0,0 +1,101 @@
+import array
+
+import numpy as np
+
+from corpus import simplified_converter
+from segmenter import HAN_RE
+
+# Multiplier of the polynomial hash of the shingles
+SHINGLE_BASE = np.uint64(1000003)
+
+def normalize(lines, convert=None):
+    """Get the Chinese text of the lines in simplified characters, as one string
+
+    The punctuation, the latin words, the tags and the line breaks are left
+    out, two releases cutting or formatting their cues differently.
+    """
+    convert = convert or simplified_converter()
+    return ''.join(HAN_RE.findall(convert('\n'.join(lines))))
+
+def mix(hashes):
+    """Spread the bits of uint64 hashes (the splitmix64 finalizer)"""
+    hashes = hashes ^ (hashes >> np.uint64(30))
+    hashes = hashes * np.uint64(0xbf58476d1ce4e5b9)
+    hashes = hashes ^ (hashes >> np.uint64(27))
+    hashes = hashes * np.uint64(0x94d049bb133111eb)
+    return hashes ^ (hashes >> np.uint64(31))
+
+def shingle_hashes(text, size=5):
+    """Get the distinct 64 bit hashes of the `size` characters shingles of a text"""
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < size:
+        return np.zeros(0, dtype=np.uint64)
+
+    n = len(codes) - size + 1
+    hashes = np.zeros(n, dtype=np.uint64)
+    for i in range(size):
+        hashes = hashes * SHINGLE_BASE + codes[i:i + n]
+
+    return np.unique(mix(hashes))
+
+def simhash(hashes):
+    """Get the 64 bit SimHash of a set of hashes, the majority of every bit, None if empty"""
+    if not len(hashes):
+        return None
+
+    bits = (hashes[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    majority = bits.sum(axis=0) * 2 > len(hashes)
+
+    return int((majority.astype(np.uint64) << np.arange(64, dtype=np.uint64)).sum())
+
+def jaccard(a, b):
+    """Get the Jaccard similarity of two sets of distinct hashes"""
+    if not len(a) or not len(b):
+        return 0.0
+
+    shared = len(np.intersect1d(a, b, assume_unique=True))
+    return shared / (len(a) + len(b) - shared)
+
+def fingerprint(lines, convert=None, size=5):
+    """Get the SimHash of the shingles of the normalized text of the lines
+
+    Subtitles sharing most of their text have fingerprints a few bits apart,
+    about 6 of the 64 bits for 5% of the lines changed, unrelated ones
+    differing by 32 bits on average. None when there is no Chinese text.
+    """
+    return simhash(shingle_hashes(normalize(lines, convert), size))
+
+class SimHashIndex:
+    """Fingerprints of the subtitles, with the ones close to a fingerprint
+
+    The fingerprints are kept in one uint64 array and the distances to a
+    query are computed for all of them at once, which takes a few
+    milliseconds for a hundred thousand subtitles.
+
+    Args:
+        max_distance (int, optional): The most bits a candidate differs by
+    """
+
+    def __init__(self, max_distance=18):
+        self.max_distance = max_distance
+        self.names = []
+        self.fingerprints = array.array('Q')
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, fingerprint):
+        if fingerprint is not None:
+            self.names.append(name)
+            self.fingerprints.append(fingerprint)
+
+    def candidates(self, fingerprint):
+        """Get the (distance, name) of the fingerprints at most `max_distance` bits away, the closest first"""
+        if fingerprint is None or not len(self.names):
+            return []
+
+        differing = (np.frombuffer(self.fingerprints, dtype=np.uint64) ^ np.uint64(fingerprint)).view(np.uint8)
+        distances = np.unpackbits(differing).reshape(-1, 64).sum(axis=1)
+        close = np.flatnonzero(distances <= self.max_distance)
+
+        return sorted(zip(distances[close].tolist(), [self.names[i] for i in close.tolist()]))
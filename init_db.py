@@ -1,55 +1,186 @@
-from scrapper import extract
+from scrapper import extract, ResponseCache
 import re
 import string
 import argparse
 import re
 import sys
-from subprocess import Popen, PIPE
 import os
-import glob
+import json
+import time
+import zipfile
+import tempfile
+import threading
+from io import BytesIO
+from functools import partial
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import rarfile
+import requests
+
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
 
 from subhd.main import SubHDApp
 from subhd.subtitle import *
 from subhd.search import SubHDSearch
 
+import instrument
+from instrument import stage
 from compare import RAW_SUBTITLES_PATH, crush_subtitles
 
-from subprocess import STDOUT, check_output
-import subprocess
+HARVEST_CHECKPOINT_PATH = os.path.join('data', 'harvest.json')
+
+class HostRateLimiter:
+    """Space the requests made to a same host by at least `interval` seconds"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+
+        time.sleep(slot - now)
+
+rate_limiter = HostRateLimiter()
+
+def http(method, url, retries=3, backoff=2.0, **kwargs):
+    """Make a rate limited request, retried with an exponential backoff
+
+    Connection errors, 429 and 5xx responses are retried, the last response
+    or error being given back once the retries are exhausted.
+    """
+    kwargs.setdefault('timeout', 30)
+
+    with stage('init_db.http') as requesting:
+        for attempt in range(retries + 1):
+            rate_limiter.wait(url)
+            requesting.count(requests=1, retries=1 if attempt else 0)
+            try:
+                response = requests.request(method, url, **kwargs)
+            except requests.RequestException:
+                if attempt == retries:
+                    raise
+            else:
+                if (response.status_code != 429 and response.status_code < 500) or attempt == retries:
+                    if response.status_code >= 400:
+                        requesting.fail('HTTP {}'.format(response.status_code))
+                    return response
+
+            time.sleep(backoff * 2 ** attempt)
 
 def sanatize_movie_name(movie_name):
     return movie_name.replace('\n', '').replace('\t', '').replace('\r', '').strip()
 
-def get_movies_from_index(index):
+def get_movies_from_index(index, cache=None):
     if index != 'AZ':
         index = 'AZ/' + index
-    r = extract('http://chinesemov.com/{}.html'.format(index), 'ul')
-    movie_list = r[1]
-    return [(movie.get('href'), sanatize_movie_name(movie.get_text())) for movie in movie_list.find_all('a')]
+    with stage('init_db.index') as indexing:
+        r = extract('http://chinesemov.com/{}.html'.format(index), 'ul', cache=cache, fast=True, parse_only='auto')
+        movie_list = r[1]
+        movies = [(movie.get('href'), sanatize_movie_name(movie.get_text())) for movie in movie_list.find_all('a')]
+        indexing.count(movies=len(movies))
 
-def get_movies():
+    return movies
+
+def get_movies(cache=None):
     print('> Get movie names')
     list_index = list(string.ascii_uppercase) + ['AZ']
+    cache = cache or ResponseCache(ttl=24 * 3600)
     movies = []
 
-    for index in list_index:
-        movies += get_movies_from_index(index)
+    with ThreadPoolExecutor(max_workers=len(list_index)) as executor:
+        for index_movies in executor.map(partial(get_movies_from_index, cache=cache), list_index):
+            movies += index_movies
 
     return movies
 
 class FixSubHDSearch(SubHDSearch):
+    def get_content(self):
+        if not self.content:
+            with stage('subhd.search') as searching:
+                response = http('get', self.make_url())
+                if response.status_code == 200:
+                    self.content = response.text
+                    searching.count(pages=1, bytes=len(response.content))
+                else:
+                    raise SubHDDownloadException()
+        return self.content
+
     def select_subtitle(self, *, choice):
         entries = list(self.entries())
         id_entry = entries[choice - 1].path.split('/')[2]
         return FixSubHDSubtitle(id=id_entry)
 
+# Preferred subtitle names, the simplified ones first
+SUBTITLE_NAME_RES = [re.compile(r, re.IGNORECASE) for r in
+    [r'简体', r'chs', r'(^|[^a-z])zh([^a-z]|$)', r'(^|[^a-z])(gb|sc)([^a-z]|$)', r'(简|中)', r'.']]
+# Traditional subtitles are only picked when there is nothing else, English ones
+# are only passed over for an equally good name
+TRADITIONAL_NAME_RE = re.compile(r'(繁|cht|big5|(^|[^a-z])tw([^a-z]|$))', re.IGNORECASE)
+DEPRIORITIZED_NAME_RE = re.compile(r'eng', re.IGNORECASE)
+
+def pick_subtitle(names):
+    """Choose the best Chinese .srt among the names of an archive members"""
+    names = [name for name in names
+        if name.lower().endswith('.srt') and not name.startswith('__MACOSX') and not name.endswith('/')]
+
+    def rank(name):
+        base = name.split('/')[-1]
+        priority = next(i for i, name_re in enumerate(SUBTITLE_NAME_RES) if name_re.search(base))
+        return bool(TRADITIONAL_NAME_RE.search(base)), priority, bool(DEPRIORITIZED_NAME_RE.search(base)), name
+
+    return min(names, key=rank) if names else None
+
+def read_archive(archive, archive_type):
+    """Get the names of the members of an in-memory archive and a reader"""
+    if archive_type == 'zip':
+        opened = zipfile.ZipFile(archive)
+        # Names without the UTF-8 flag are read as cp437 by zipfile, they are
+        # usually GBK on Chinese archives
+        members = {}
+        for info in opened.infolist():
+            name = info.filename
+            if not info.flag_bits & 0x800:
+                try:
+                    name = name.encode('cp437').decode('gb18030', 'replace')
+                except UnicodeEncodeError:
+                    pass
+            members[name] = info
+        return list(members), lambda name: opened.read(members[name])
+    elif archive_type == 'rar':
+        # rarfile fails with a TypeError on an in-memory file which is not a RAR
+        if not rarfile.is_rarfile(archive):
+            raise rarfile.NotRarFile('The archive is not a RAR archive')
+        archive.seek(0)
+        opened = rarfile.RarFile(archive)
+        return opened.namelist(), opened.read
+    elif archive_type == '7z':
+        if not py7zr:
+            raise SubHDDecompressException('7z archives need py7zr to be installed')
+        with py7zr.SevenZipFile(archive) as opened:
+            members = {name: content.read() for name, content in opened.readall().items()}
+        return list(members), members.get
+    else:
+        message = "Archive type {0} is not yet " \
+                  "supported".format(archive_type)
+        raise SubHDDecompressException(message)
+
 class FixSubHDSubtitle(SubHDSubtitle):
     def __init__(self, id):
         super(FixSubHDSubtitle, self).__init__(id)
         self.archive_name = None
 
     def get_file_url(self):
-        response = requests.post(AJAX_ENDPOINT, data={"sub_id": self.id})
+        response = http('post', AJAX_ENDPOINT, data={"sub_id": self.id})
         url = response.json().get("url")
         if url == "http://dl.subhd.com":
             raise SubHDDownloadException()
@@ -59,96 +190,144 @@ class FixSubHDSubtitle(SubHDSubtitle):
             return url
 
     def download_archive(self):
-        response = requests.get(self.get_file_url())
+        with stage('subhd.download') as downloading:
+            response = http('get', self.get_file_url(), stream=True)
+            archive = BytesIO()
 
-        with open(self.archive_name, 'wb') as archive:
             for chunk in response.iter_content(CHUNK_SIZE):
                 archive.write(chunk)
+            downloading.count(archives=1, bytes=archive.tell())
+            archive.seek(0)
+
+        return archive
 
     def extract_subtitles(self):
-        self.download_archive()
-        cmds = []
-
-        if self.archive_type == 'rar':
-            cmds = ['unrar', 'x']
-        elif self.archive_type == 'zip':
-            cmds = ['unzip']
-        elif self.archive_type == '7z':
-            cmds = ['7zr', 'e']
-        else:
-            message = "Archive type {0} is not yet " \
-                      "supported".format(self.archive_type)
-            raise SubHDDecompressException(message)
+        """Get the name and content of the best subtitle of the archive
 
-        cmds.append('../' + self.archive_name)
-        try:
-            check_output(cmds, stderr=STDOUT, timeout=5)
-        except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
-            os.chdir('..')
-            os.remove(self.archive_name)
-            return False
+        The archive is read in memory, without touching the disk or the
+        working directory, so several of them can be extracted at once.
+        """
+        archive = self.download_archive()
 
-        os.remove(self.archive_name)
-        return True 
+        with stage('subhd.extract') as extracting:
+            try:
+                names, read = read_archive(archive, self.archive_type)
+                name = pick_subtitle(names)
+            except (zipfile.BadZipFile, rarfile.Error, EOFError) as e:
+                extracting.fail('{} archive: {}'.format(self.archive_type, type(e).__name__))
+                message = "Archive {0} could not be read: {1}".format(self.archive_name, e)
+                raise SubHDDecompressException(message)
+
+            if not name:
+                extracting.skip('no .srt in the archive')
+                return None, None
+
+            content = read(name)
+            extracting.count(archives=1, files=1, bytes=len(content))
+            return name, content
 
     def move_subtitles(self, filename):
-        if self.extract_subtitles():
-            files = (glob.glob(os.path.join('tmp', '*', '*.简体.srt')) + glob.glob(os.path.join('tmp', '*.简体.srt')) +
-                glob.glob(os.path.join('tmp', '*', '*chs.srt')) + glob.glob(os.path.join('tmp', '*chs.srt')) + 
-                glob.glob(os.path.join('tmp', '*', '*zh.srt')) + glob.glob(os.path.join('tmp', '*zh.srt')))
-            
-            if files:
-                try:
-                    os.rename(files[0], os.path.join(RAW_SUBTITLES_PATH, filename + '.srt'))
-                except:
-                    pass
-            else:
-                files = glob.glob(os.path.join('tmp', '*', '*.srt')) + glob.glob(os.path.join('tmp', '*.srt'))
-                if files:
-                    try:
-                        os.rename(files[0], os.path.join(RAW_SUBTITLES_PATH, filename + '.srt'))
-                    except:
-                        pass
-
-            files = glob.glob(os.path.join('tmp', '*', '*')) + glob.glob(os.path.join('tmp', '*'))
-            for f in files:
-                try:
-                    pass
-                    os.remove(f)
-                except:
-                    pass
+        name, content = self.extract_subtitles()
+        if not name:
+            return False
+
+        subtitle_path = os.path.join(RAW_SUBTITLES_PATH, filename + '.srt')
+        with tempfile.NamedTemporaryFile(dir=RAW_SUBTITLES_PATH, suffix='.part', delete=False) as out_f:
+            out_f.write(content)
+        os.replace(out_f.name, subtitle_path)
+
+        return True
 
 class FixSubHDApp(SubHDApp):
     def __init__(self, filename):
         self.filename = filename
         self.search = None
+        self.reason = None
 
     def exist_subtitle(self):
+        """Search SubHD for the movie, any error but an empty search going up"""
+        self.search = FixSubHDSearch(keyword=self.filename)
+        return len(list(self.search.entries())) > 0
+
+    def main(self):
+        """Download the first subtitle of the movie, `found` or `skipped` with the reason"""
+        if not self.exist_subtitle():
+            self.reason = 'no subtitle on SubHD'
+            return 'skipped'
+
+        subtitle = self.search.select_subtitle(choice=1)
+        if not subtitle.move_subtitles(self.filename):
+            self.reason = 'no .srt in the archive'
+            return 'skipped'
+
+        return 'found'
+
+def load_checkpoint():
+    """Get the movie name -> `found` or `skipped` of the past harvests"""
+    if os.path.isfile(HARVEST_CHECKPOINT_PATH):
+        with open(HARVEST_CHECKPOINT_PATH, 'r', encoding='utf8') as in_f:
+            return json.load(in_f)
+
+    return {}
+
+def save_checkpoint(checkpoint):
+    with open(HARVEST_CHECKPOINT_PATH + '.tmp', 'w', encoding='utf8') as out_f:
+        json.dump(checkpoint, out_f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(HARVEST_CHECKPOINT_PATH + '.tmp', HARVEST_CHECKPOINT_PATH)
+
+def harvest_movie(movie_name):
+    with stage('init_db.harvest') as harvesting:
+        app = FixSubHDApp(movie_name)
         try:
-            self.search = FixSubHDSearch(keyword=self.filename)
-            return len(list(self.search.entries())) > 0
-        except:
-            pass
+            status = app.main()
+        except Exception as e:
+            harvesting.fail(type(e).__name__)
+            return 'failed', e
 
-        return False
+        if status == 'skipped':
+            harvesting.skip(app.reason)
+        harvesting.count(movies=1)
+        return status, None
 
-    def main(self):
-        if self.exist_subtitle():
-            print('Found: {}'.format(self.filename))
-            subtitle = self.search.select_subtitle(choice=1)
-            subtitle.move_subtitles(self.filename)
-        else:
-            print('Skip:  {}'.format(self.filename))
+def harvest(movies, workers=8):
+    """Download the subtitles of the movies with a bounded thread pool
 
-if __name__ == "__main__":
-    movies = get_movies()[1681+254+92+679+56+6:]
-    n = len(movies)
+    The movies found or skipped are checkpointed as soon as they are done,
+    so a new harvest only goes through the remaining and failed ones.
+    """
+    checkpoint = load_checkpoint()
+    movie_names = [name for name in dict.fromkeys(name for _, name in movies) if name not in checkpoint]
+    n = len(movie_names)
     n_length = len(str(n))
 
-    print('> Download subtitles')
-    for i, (_, movie_name) in enumerate(movies):
-        print('[{0:{2}}/{1}] '.format(i, n, n_length), end='', flush=True)
-        app = FixSubHDApp(movie_name)
-        app.main()
+    print('> Download subtitles ({} already done)'.format(len(checkpoint)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(harvest_movie, name): name for name in movie_names}
+
+        for i, future in enumerate(as_completed(futures)):
+            movie_name, (status, error) = futures[future], future.result()
+            print('[{0:{2}}/{1}] {3:8} {4}'.format(i + 1, n, n_length, status.capitalize() + ':', movie_name)
+                + (' ({})'.format(error) if error else ''), flush=True)
+
+            if status != 'failed':
+                checkpoint[movie_name] = status
+                save_checkpoint(checkpoint)
+
+    instrument.snapshot()
+    return checkpoint
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8, help='number of movies harvested at once')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between two requests to a same host')
+    parser.add_argument('--metrics', metavar='DIR', default=instrument.INSTRUMENT_PATH,
+        help='record the time and items of every stage in DIR, as JSON lines and a Prometheus textfile')
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrument.enable(args.metrics)
+
+    rate_limiter.interval = args.interval
+    harvest(get_movies(), workers=args.workers)
 
     crush_subtitles()
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import atexit
+import threading
+from os import path
+
+INSTRUMENT_PATH = os.environ.get('INSTRUMENT_PATH')
+METRICS_PREFIX  = 'learn_chinese'
+
+# CPU time of the calling thread when Python can tell it, of the process otherwise
+cpu_time = getattr(time, 'thread_time', time.process_time)
+
+class Stage:
+    """A timed run of a stage of the pipeline, used as a context manager
+
+    The items processed are added up with `count`. A stage leaving on an
+    exception is recorded as failed with the exception type as reason, and
+    `skip` or `fail` give the reason of a stage which did not go through.
+    """
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.items = {}
+        self.status = 'ok'
+        self.reason = None
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = cpu_time()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        if kind is not None and self.status == 'ok':
+            self.fail(kind.__name__)
+        self.recorder.record(self, time.perf_counter() - self.wall, cpu_time() - self.cpu)
+        return False
+
+    def count(self, **items):
+        for item, n in items.items():
+            self.items[item] = self.items.get(item, 0) + n
+
+    def skip(self, reason):
+        self.status, self.reason = 'skipped', reason
+
+    def fail(self, reason):
+        self.status, self.reason = 'failed', reason
+
+class NullStage:
+    """What `stage` gives when the instrumentation is off, doing nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        return False
+
+    def count(self, **items):
+        pass
+
+    def skip(self, reason):
+        pass
+
+    def fail(self, reason):
+        pass
+
+null_stage = NullStage()
+
+class Recorder:
+    """Totals of every stage, written as JSON lines and a Prometheus textfile
+
+    Every finished stage is appended to `stages.jsonl` with its wall and CPU
+    time, its items and their rates per second. `snapshot` writes the totals
+    in `learn_chinese.prom` for the textfile collector of the node exporter.
+
+    Args:
+        directory (str): Where the two files are written
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.stages = {}
+        os.makedirs(directory, exist_ok=True)
+        self.events = open(path.join(directory, 'stages.jsonl'), 'a', encoding='utf8')
+
+    def record(self, stage, wall, cpu):
+        event = {
+              'time': time.time()
+            , 'stage': stage.name
+            , 'status': stage.status
+            , 'reason': stage.reason
+            , 'wall': wall
+            , 'cpu': cpu
+            , 'items': stage.items
+            , 'rates': {item: n / wall for item, n in stage.items.items() if wall > 0}
+        }
+
+        with self.lock:
+            totals = self.stages.setdefault(stage.name,
+                {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'items': {}, 'failed': {}, 'skipped': {}})
+            totals['calls'] += 1
+            totals['wall'] += wall
+            totals['cpu'] += cpu
+            for item, n in stage.items.items():
+                totals['items'][item] = totals['items'].get(item, 0) + n
+            if stage.status != 'ok':
+                reasons = totals[stage.status]
+                reasons[stage.reason] = reasons.get(stage.reason, 0) + 1
+
+            self.events.write(json.dumps(event, ensure_ascii=False) + '\n')
+            self.events.flush()
+
+    def snapshot(self):
+        """Write the totals of the stages in the Prometheus text format"""
+        lines = []
+        metrics = [
+              ('stage_calls_total', 'Runs of the stage', lambda s: [('', s['calls'])])
+            , ('stage_wall_seconds_total', 'Wall time spent in the stage', lambda s: [('', s['wall'])])
+            , ('stage_cpu_seconds_total', 'CPU time spent in the stage', lambda s: [('', s['cpu'])])
+            , ('stage_items_total', 'Items processed by the stage',
+                lambda s: [(',item="{}"'.format(item), n) for item, n in sorted(s['items'].items())])
+            , ('stage_failures_total', 'Failed runs of the stage by reason',
+                lambda s: [(',reason="{}"'.format(escape(reason)), n) for reason, n in sorted(s['failed'].items())])
+            , ('stage_skips_total', 'Skipped runs of the stage by reason',
+                lambda s: [(',reason="{}"'.format(escape(reason)), n) for reason, n in sorted(s['skipped'].items())])
+        ]
+
+        with self.lock:
+            for metric, description, samples in metrics:
+                name = '{}_{}'.format(METRICS_PREFIX, metric)
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} counter'.format(name))
+                for stage_name, totals in sorted(self.stages.items()):
+                    for labels, value in samples(totals):
+                        lines.append('{}{{stage="{}"{}}} {}'.format(name, stage_name, labels, value))
+
+        filename = path.join(self.directory, METRICS_PREFIX + '.prom')
+        with open(filename + '.tmp', 'w', encoding='utf8') as out_f:
+            out_f.write('\n'.join(lines) + '\n')
+        os.replace(filename + '.tmp', filename)
+
+    def close(self):
+        self.snapshot()
+        self.events.close()
+
+def escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+recorder = None
+
+def enable(directory=INSTRUMENT_PATH):
+    """Start recording the stages in `directory`, the snapshot being written at exit"""
+    global recorder
+    if recorder is None:
+        recorder = Recorder(directory)
+        atexit.register(recorder.close)
+
+    return recorder
+
+def stage(name):
+    """Time a stage of the pipeline, see `Stage`. Nothing is recorded unless enabled."""
+    return Stage(recorder, name) if recorder is not None else null_stage
+
+def snapshot():
+    """Write the Prometheus snapshot now, when a long run reaches a milestone"""
+    if recorder is not None:
+        recorder.snapshot()
+
+if INSTRUMENT_PATH:
+    enable()
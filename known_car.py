@@ -1,28 +1,147 @@
 import os
+import re
 import glob
 import sys
-from subprocess import Popen, PIPE
+import time
 import string
+import sqlite3
+from contextlib import closing
+
+from segmenter import segment_paths
+from scores import update_user_scores
+from corpus import simplified_converter
+
+USERS_DB_PATH = os.path.join('users', 'users.db')
+
+# User names end up in file names, users/<user>.txt and data/scores/<user>.npz
+USER_NAME_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+def connect():
+    """Open the user vocabulary store
+
+    The words are rows of a SQLite database in WAL mode, so adding words
+    only writes the new ones and several processes can write at once.
+    """
+    connection = sqlite3.connect(USERS_DB_PATH, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS users (
+            name TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS words (
+            user TEXT NOT NULL,
+            word TEXT NOT NULL,
+            learned_at REAL NOT NULL,
+            source TEXT,
+            PRIMARY KEY (user, word)
+        ) WITHOUT ROWID;
+    ''')
+
+    return connection
+
+_convert = None
+
+def canonical_words(words):
+    """Add the simplified form of the words to them
+
+    A word learned in traditional characters is then known under both forms,
+    even when the subtitles only have its simplified form.
+    """
+    global _convert
+    if _convert is None:
+        _convert = simplified_converter()
+
+    words = [word for word in set(words) if '\n' not in word]
+    return set(words) | set(_convert('\n'.join(words)).split('\n')) - {''}
+
+def is_valid_user(user):
+    """Check that a user name is letters, digits, `_` and `-` only"""
+    return bool(USER_NAME_RE.fullmatch(user))
+
+def user_exists(user):
+    """Check whether a user is registered or has a former users/<user>.txt words list"""
+    if not is_valid_user(user):
+        return False
+    if os.path.isfile(os.path.join('users', user + '.txt')):
+        return True
+
+    with closing(connect()) as connection:
+        return connection.execute('SELECT 1 FROM users WHERE name = ?', (user,)).fetchone() is not None
+
+def ensure_user(connection, user):
+    """Register a user, importing its former users/<user>.txt words list"""
+    if not is_valid_user(user):
+        raise ValueError('`{}` is not a valid user name'.format(user))
+
+    with connection:
+        if connection.execute('INSERT OR IGNORE INTO users (name) VALUES (?)', (user,)).rowcount == 0:
+            return
+
+        path = os.path.join('users', user + '.txt')
+        if os.path.isfile(path):
+            with open(path, 'r') as in_f:
+                chars = in_f.read().replace('\n', '')
+            learned_at = os.path.getmtime(path)
+            connection.executemany('INSERT OR IGNORE INTO words VALUES (?, ?, ?, ?)',
+                ((user, word, learned_at, path) for word in chars.split(',') if word))
+
+def import_user(connection, user):
+    """Import the former users/<user>.txt words list of a user being read, if any
+
+    Reading never registers a user without one, only `add_user_words` does.
+    """
+    if not is_valid_user(user):
+        raise ValueError('`{}` is not a valid user name'.format(user))
+
+    if os.path.isfile(os.path.join('users', user + '.txt')):
+        ensure_user(connection, user)
 
 def get_user_words(user):
-    """Get a user words list"""
-    path = os.path.join('users', user + '.txt')
+    """Get a user words list, with the simplified form of its words (see `canonical_words`)
 
-    if os.path.isfile(path):
-        with open(path, 'r') as in_f:
-            chars = in_f.readlines()[0].replace('\n', '')
-            if chars:
-                return set(chars.split(','))
+    An unknown user knows no words.
+    """
+    with closing(connect()) as connection:
+        import_user(connection, user)
+        return canonical_words(word for word, in connection.execute('SELECT word FROM words WHERE user = ?', (user,)))
 
-    return set()
+def get_user_words_info(user):
+    """Get the (word, learned_at, source) of the words of a user"""
+    with closing(connect()) as connection:
+        import_user(connection, user)
+        return connection.execute(
+            'SELECT word, learned_at, source FROM words WHERE user = ? ORDER BY learned_at', (user,)).fetchall()
 
-def add_user_words(user, words):
-    """Add words to a user list"""
-    path = os.path.join('users', user + '.txt')
-    words |= get_user_words(user)
+def get_users():
+    """Get the names of all the users having a words list"""
+    legacy = [os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join('users', '*.txt'))]
 
-    with open(path, 'w') as out_f:
-       out_f.write(','.join(words))
+    with closing(connect()) as connection:
+        users = [name for name, in connection.execute('SELECT name FROM users')]
+
+    return sorted(set(users) | set(legacy))
+
+def add_user_words(user, words, source=None, corpus=None):
+    """Add words to a user list
+
+    Only the words the user did not know are written, with the time and
+    the source they were learned from. The cached scores of the user, if
+    any, are updated with these words only (see `scores.update_user_scores`).
+    """
+    learned_at = time.time()
+    new_words = set()
+
+    with closing(connect()) as connection:
+        ensure_user(connection, user)
+        with connection:
+            for word in set(words):
+                inserted = connection.execute('INSERT OR IGNORE INTO words VALUES (?, ?, ?, ?)',
+                    (user, word, learned_at, source)).rowcount
+                if inserted:
+                    new_words.add(word)
+
+    update_user_scores(user, canonical_words(new_words), corpus)
+    return new_words
 
 def clean_file(path):
     """Remove the non-Chinese words from a file
@@ -51,14 +170,16 @@ def segment_files(paths):
 
     This function takes in a bunch all the files fed and segment
     each line into a list of words. It uses the standford segmenter 
-    which takes some time to initialize. It is then better when 
-    given small files to give them all at once.
+    which takes some time to initialize, so the same segmenter is
+    kept for the whole process (see `segmenter.get_segmenter`).
+    The pure Python segmenter is used when `SEGMENTER_BACKEND` is
+    `dictionary`.
     """
     paths = paths if type(paths) is list else [paths]
-    paths = ','.join([os.path.join('..', path) for path in paths])
-    process = Popen(['./segment.sh', paths], stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-    segmented_text = stdout.decode('UTF-8').split('\n')
+    segmented_text = []
+
+    for _, segmented in segment_paths(paths):
+        segmented_text += segmented
     
     return segmented_text
 
@@ -73,7 +194,7 @@ def add_file_to_user(user, path):
     path = clean_file(path)
     segmented = ' '.join(segment_files(path))
     segmented = set(segmented.replace(' ', ','))
-    add_user_words(user, segmented)
+    add_user_words(user, segmented, source=path)
 
 if __name__ == "__main__":
     path = sys.argv[1]
@@ -0,0 +1,204 @@
+import sys
+import json
+import fnmatch
+import argparse
+from os import path
+
+import numpy as np
+
+from corpus import CORPUS_PATH, is_fresh, load_corpus
+from known_car import get_user_words
+from segmenter import HAN_RE
+from store import STORE_PATH, load_store
+
+LINES_PATH = path.join('data', 'lines.npz')
+
+def line_sums(values, indptr):
+    """Sum `values` over every line, the lines being cut by `indptr`"""
+    sums = np.zeros(len(values) + 1, dtype=np.float64 if values.dtype.kind == 'f' else np.int64)
+    np.cumsum(values, out=sums[1:])
+    return sums[indptr[1:]] - sums[indptr[:-1]]
+
+class LineIndex:
+    """Canonical token ids of every line of the corpus, as one flat array.
+
+    The lines of all the movies are laid end to end: the tokens of line `l`
+    are `tokens[indptr[l]:indptr[l + 1]]` and the lines of movie `m` are
+    `movie_indptr[m]` to `movie_indptr[m + 1]`. A word counted against a
+    mask of the vocabulary is then a lookup over the tokens and a cumulative
+    sum, for the millions of lines at once.
+
+    The token ids are the ones of the `Corpus`, a word of the `CorpusStore`
+    missing from it getting `len(corpus.words)`, past the last word.
+
+    Args:
+        files (list of str): The file names of the movies
+
+        tokens (numpy.ndarray): The token ids of all the lines
+
+        indptr (numpy.ndarray): Start of every line in `tokens`
+
+        movie_indptr (numpy.ndarray): Start of every movie in the lines
+    """
+
+    def __init__(self, files, tokens, indptr, movie_indptr):
+        self.files = list(files)
+        self.tokens = tokens
+        self.indptr = indptr
+        self.movie_indptr = movie_indptr
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def build(cls, corpus, store):
+        """Lay the lines of the movies of both `corpus` and `store` end to end"""
+        canonical = np.array([corpus.vocabulary.get(word, len(corpus.words)) for word in store.words], dtype=np.int32)
+        files = [name for name in corpus.files if name in store]
+        tokens = []
+        indptr = [np.zeros(1, dtype=np.int64)]
+        movie_indptr = [0]
+        n_tokens = 0
+
+        for name in files:
+            line_indptr, movie_tokens = store.lines(name)
+            tokens.append(canonical[movie_tokens])
+            indptr.append(line_indptr[1:].astype(np.int64) + n_tokens)
+            n_tokens += len(movie_tokens)
+            movie_indptr.append(movie_indptr[-1] + len(line_indptr) - 1)
+
+        return cls(files,
+            np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.int32),
+            np.concatenate(indptr),
+            np.array(movie_indptr, dtype=np.int64))
+
+    def save(self, filename=LINES_PATH):
+        np.savez(filename,
+            files=np.array(self.files, dtype=str),
+            tokens=self.tokens,
+            indptr=self.indptr,
+            movie_indptr=self.movie_indptr)
+
+    @classmethod
+    def load(cls, filename=LINES_PATH):
+        with np.load(filename, allow_pickle=False) as archive:
+            return cls(archive['files'].tolist(), archive['tokens'], archive['indptr'], archive['movie_indptr'])
+
+    def movies(self):
+        """Get the movie of every line"""
+        return np.repeat(np.arange(len(self.files)), np.diff(self.movie_indptr))
+
+    def select(self, path_re='*'):
+        """Get a mask of the lines of the movies whose file name matches `path_re`"""
+        if path_re == '*':
+            return np.ones(len(self), dtype=bool)
+
+        selected = np.array([fnmatch.fnmatch(f, path_re) for f in self.files] + [False])
+        return selected[self.movies()]
+
+def load_line_index(corpus, store, filename=LINES_PATH):
+    """Load the line index, building it again if the corpus or the store changed"""
+    if is_fresh(filename, CORPUS_PATH, STORE_PATH):
+        index = LineIndex.load(filename)
+        if index.files == [name for name in corpus.files if name in store]:
+            return index
+
+    index = LineIndex.build(corpus, store)
+    index.save(filename)
+
+    return index
+
+def mine_sentences(user_words, corpus=None, store=None, index=None, k=1, min_words=3, per_word=3, path_re='*'):
+    """Yield the lines with 1 to `k` unknown words, the most useful first
+
+    Only the words with Chinese characters count, as in `study.study_list`:
+    a line needs `min_words` of them, and the punctuation or the latin words
+    are never unknown. The lines with fewer unknown words come first, then
+    the ones whose unknown words are the most frequent in the corpus, on the
+    mean of the log of their number of occurrences.
+
+    A line found again in another movie is given once, and only `per_word`
+    lines are given for the same unknown words, so that the first lines
+    teach different words.
+
+    Args:
+        user_words (set): The words known by the user
+
+        k (int, optional): The most unknown words of a line
+
+        min_words (int, optional): The fewest Chinese words of a line
+
+        per_word (int, optional): The most lines for the same unknown words,
+            no limit if 0
+
+        path_re (str, optional): The movies to mine
+
+    Yields:
+        The movie, the line number, the segmented line, its unknown words and
+        the usefulness of the line.
+    """
+    corpus = corpus or load_corpus()
+    store = store or load_store()
+    index = index or load_line_index(corpus, store)
+
+    # One more entry for the words of the store missing from the corpus
+    chinese = np.array([bool(HAN_RE.search(word)) for word in corpus.words] + [False])
+    unknown = chinese & ~np.append(corpus.known_mask(user_words), False)
+    usefulness = np.append(np.log1p(corpus.token_frequency), 0.0)
+
+    unknown_tokens = unknown[index.tokens]
+    n_unknown = line_sums(unknown_tokens, index.indptr)
+    n_chinese = line_sums(chinese[index.tokens], index.indptr)
+
+    lines = np.flatnonzero((n_unknown >= 1) & (n_unknown <= k) & (n_chinese >= min_words) & index.select(path_re))
+    weights = np.where(unknown_tokens, usefulness[index.tokens], 0.0)
+    scores = line_sums(weights, index.indptr)[lines] / n_unknown[lines]
+    lines = lines[np.lexsort((-scores, n_unknown[lines]))]
+
+    movies = np.searchsorted(index.movie_indptr, lines, side='right') - 1
+    seen = set()
+    taught = {}
+    for line, movie in zip(lines.tolist(), movies.tolist()):
+        tokens = index.tokens[index.indptr[line]:index.indptr[line + 1]]
+        key = tokens.tobytes()
+        if key in seen:
+            continue
+        seen.add(key)
+
+        words = tokens[unknown[tokens]]
+        taught_key = tuple(np.unique(words).tolist())
+        if per_word and taught.get(taught_key, 0) >= per_word:
+            continue
+        taught[taught_key] = taught.get(taught_key, 0) + 1
+
+        file_name = index.files[movie]
+        yield {
+              'movie': file_name
+            , 'line_number': line - int(index.movie_indptr[movie])
+            , 'line': store.line(file_name, line - int(index.movie_indptr[movie]))
+            , 'unknown': [corpus.words[w] for w in taught_key]
+            , 'usefulness': float(usefulness[words].mean())
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lines of the movies with one word, or a few, to learn')
+    parser.add_argument('user')
+    parser.add_argument('-n', type=int, default=50, help='number of lines to show, all of them if negative')
+    parser.add_argument('-k', type=int, default=1, help='most unknown words of a line')
+    parser.add_argument('--min-words', type=int, default=3, help='fewest Chinese words of a line')
+    parser.add_argument('--per-word', type=int, default=3, help='most lines for the same unknown words, 0 for no limit')
+    parser.add_argument('--path-re', default='*', help='movies to mine')
+    parser.add_argument('--stream', action='store_true', help='write the lines as JSON lines as soon as they are found')
+    args = parser.parse_args()
+
+    sentences = mine_sentences(get_user_words(args.user), k=args.k, min_words=args.min_words,
+        per_word=args.per_word, path_re=args.path_re)
+    for i, sentence in enumerate(sentences):
+        if i == args.n:
+            break
+        if args.stream:
+            sys.stdout.write(json.dumps(sentence, ensure_ascii=False) + '\n')
+            sys.stdout.flush()
+        else:
+            print('>  {}\t{}\t({}, line {})'.format(
+                ' '.join(sentence['unknown']), sentence['line'], sentence['movie'], sentence['line_number']))
@@ -0,0 +1,90 @@
+import heapq
+import argparse
+
+import numpy as np
+
+from corpus import load_corpus
+from known_car import get_user_words
+
+def plan_resources(user, target, corpus=None, weighted=False, max_resources=None):
+    """Find a small set of movies covering the unknown words of a target movie
+
+    This is a greedy set cover: the movie bringing the most uncovered words
+    is taken, again and again. The gains only go down as words get covered,
+    so they are kept in a priority queue and only the top one is computed
+    again (lazy greedy), most movies never being looked at twice.
+
+    Args:
+        user (str): The user whose known words are left out
+
+        target (str): The crushed file name of the movie to prepare
+
+        weighted (bool, optional): Weight the words by their number of
+            occurrences in the target instead of counting them once
+
+        max_resources (int, optional): Stop after this number of movies
+
+    Returns:
+        The list of the chosen movies with the words each of them brings,
+        in the order they were picked, and the words no movie covers.
+    """
+    corpus = corpus or load_corpus()
+    row = corpus.find(target)
+    known = corpus.known_mask(get_user_words(user))
+
+    target_words = corpus.counts.indices[corpus.counts.indptr[row]:corpus.counts.indptr[row + 1]]
+    target_counts = corpus.counts.data[corpus.counts.indptr[row]:corpus.counts.indptr[row + 1]]
+    unknown = ~known[target_words]
+    words, weights = target_words[unknown], target_counts[unknown] if weighted else np.ones(unknown.sum(), dtype=np.int64)
+
+    # Movies x unknown words of the target
+    covering = corpus.by_word[:, words].tocsr()
+    covering.data[:] = 1
+    uncovered = np.ones(len(words), dtype=bool)
+
+    def gain(movie):
+        covered = covering.indices[covering.indptr[movie]:covering.indptr[movie + 1]]
+        return int(weights[covered[uncovered[covered]]].sum())
+
+    queue = [(-gain(movie), movie) for movie in np.flatnonzero(np.diff(covering.indptr)) if movie != row]
+    heapq.heapify(queue)
+
+    plan = []
+    names = corpus.names
+    total = int(weights.sum())
+    covered_weight = 0
+    while queue and uncovered.any() and (max_resources is None or len(plan) < max_resources):
+        _, movie = heapq.heappop(queue)
+        movie_gain = gain(movie)
+        if movie_gain <= 0:
+            continue
+        if queue and movie_gain < -queue[0][0]:
+            heapq.heappush(queue, (-movie_gain, movie))
+            continue
+
+        covered = covering.indices[covering.indptr[movie]:covering.indptr[movie + 1]]
+        new_words = covered[uncovered[covered]]
+        uncovered[new_words] = False
+        covered_weight += movie_gain
+
+        plan.append({
+              'name': names[movie]
+            , 'new_words': [corpus.words[w] for w in words[new_words]]
+            , 'gain': movie_gain
+            , 'coverage': int(covered_weight / total * 100) if total else 100
+        })
+
+    return plan, [corpus.words[w] for w in words[uncovered]]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Movies to watch before a target movie')
+    parser.add_argument('user')
+    parser.add_argument('target', help='crushed subtitle of the target movie')
+    parser.add_argument('--weighted', action='store_true', help='weight the words by their frequency in the target')
+    parser.add_argument('-n', type=int, default=None, help='maximum number of movies')
+    args = parser.parse_args()
+
+    plan, uncovered = plan_resources(args.user, args.target, weighted=args.weighted, max_resources=args.n)
+    for resource in plan:
+        print('>  {}%:\t{} (+{})'.format(resource['coverage'], resource['name'], len(resource['new_words'])))
+    print('> {} words left uncovered'.format(len(uncovered)))
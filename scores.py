@@ -0,0 +1,138 @@
+import os
+import sys
+from os import path
+
+import numpy as np
+
+from corpus import load_corpus
+
+SCORES_PATH = path.join('data', 'scores')
+
+class UserScores:
+    """Known token and known unique word counts of a user for every movie.
+
+    The counts are kept with the mask of the words they were computed from,
+    so learning words only adds the postings of the new words (the movies
+    containing them) instead of scoring the whole corpus again.
+
+    Args:
+        user (str): The user name
+
+        corpus (Corpus): The corpus the counts refer to
+
+        known (numpy.ndarray): The known mask over the canonical words
+
+        similar_count, similar_u_count (numpy.ndarray): The counts per movie
+    """
+
+    def __init__(self, user, corpus, known, similar_count, similar_u_count):
+        self.user = user
+        self.corpus = corpus
+        self.known = known
+        self.similar_count = similar_count
+        self.similar_u_count = similar_u_count
+
+    @classmethod
+    def compute(cls, user, user_words, corpus):
+        known = corpus.known_mask(user_words)
+        similar_count, similar_u_count = corpus.similar_counts(known)
+
+        return cls(user, corpus, known, similar_count, similar_u_count)
+
+    @staticmethod
+    def filename(user):
+        return path.join(SCORES_PATH, user + '.npz')
+
+    def save(self):
+        os.makedirs(SCORES_PATH, exist_ok=True)
+        tmp_file = self.filename(self.user) + '.tmp.npz'
+        np.savez(tmp_file,
+            signature=np.array(self.corpus.signature),
+            known=np.flatnonzero(self.known),
+            similar_count=self.similar_count,
+            similar_u_count=self.similar_u_count)
+        os.replace(tmp_file, self.filename(self.user))
+
+    @classmethod
+    def load(cls, user, corpus):
+        """Load the scores of a user, None if there are none for this corpus"""
+        if not path.isfile(cls.filename(user)):
+            return None
+
+        with np.load(cls.filename(user), allow_pickle=False) as archive:
+            if str(archive['signature']) != corpus.signature:
+                return None
+
+            known = np.zeros(len(corpus.words), dtype=bool)
+            known[archive['known']] = True
+            return cls(user, corpus, known, archive['similar_count'], archive['similar_u_count'])
+
+    def add_words(self, words):
+        """Update the counts with newly known words
+
+        Only the movies in the postings of the words not known yet are
+        touched, through the word -> movies CSC view of the corpus.
+        """
+        ids = {self.corpus.vocabulary[word] for word in words if word in self.corpus.vocabulary}
+        ids = np.array([i for i in ids if not self.known[i]], dtype=np.int64)
+        if not len(ids):
+            return 0
+
+        by_word = self.corpus.by_word
+        starts, ends = by_word.indptr[ids], by_word.indptr[ids + 1]
+        postings = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+        np.add.at(self.similar_count, by_word.indices[postings], by_word.data[postings])
+        np.add.at(self.similar_u_count, by_word.indices[postings], 1)
+        self.known[ids] = True
+
+        return len(ids)
+
+    def ranking(self, n=-1):
+        """Get the movies ranked by their percentage of known tokens"""
+        corpus = self.corpus
+        rows = np.flatnonzero(corpus.all_count > 0)
+        percentage_similar = (self.similar_count[rows] / corpus.all_count[rows] * 100).astype(np.int64)
+        percentage_u_similar = (self.similar_u_count[rows] / corpus.all_u_count[rows] * 100).astype(np.int64)
+        order = np.argsort(-percentage_similar, kind='stable')
+        order = order[:n] if n > 0 else order
+        names = corpus.names
+
+        return [{
+              'name': names[rows[j]]
+            , 'all_count': int(corpus.all_count[rows[j]])
+            , 'similar_count': int(self.similar_count[rows[j]])
+            , 'percentage_similar': int(percentage_similar[j])
+            , 'all_u_count': int(corpus.all_u_count[rows[j]])
+            , 'similar_u_count': int(self.similar_u_count[rows[j]])
+            , 'percentage_u_similar': int(percentage_u_similar[j])
+        } for j in order]
+
+def load_user_scores(user, user_words, corpus=None):
+    """Load the cached scores of a user, computing them if there are none"""
+    corpus = corpus or load_corpus()
+    scores = UserScores.load(user, corpus)
+
+    if scores is None:
+        scores = UserScores.compute(user, user_words, corpus)
+        scores.save()
+
+    return scores
+
+def update_user_scores(user, words, corpus=None):
+    """Add learned words to the cached scores of a user, if they are cached"""
+    if not path.isfile(UserScores.filename(user)):
+        return None
+
+    corpus = corpus or load_corpus()
+    scores = UserScores.load(user, corpus)
+    if scores is not None and scores.add_words(words):
+        scores.save()
+
+    return scores
+
+if __name__ == "__main__":
+    from known_car import get_user_words
+
+    user = sys.argv[1] if len(sys.argv) > 1 else 'rinku'
+    for subtitle in load_user_scores(user, get_user_words(user)).ranking(10):
+        print('>  {}%:\t{}'.format(subtitle['percentage_similar'], subtitle['name']))
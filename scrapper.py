@@ -1,11 +1,114 @@
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from subprocess import call
 import subprocess
 import os
+import re
+import json
+import time
+import hashlib
+from contextlib import closing
 from functools import partial
-from multiprocessing import Pool
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from instrument import stage
+
+try:
+    import lxml
+    FAST_PARSER = 'lxml'
+except ImportError:
+    FAST_PARSER = 'html.parser'
+
+CACHE_PATH = os.path.join('.cache', 'http')
+
+def make_session(pool_size=20):
+    """Get a `requests.Session` keeping up to `pool_size` connections per host"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+session = make_session()
+
+class ResponseCache:
+    """On-disk cache of the pages, keyed by url.
+
+    A page younger than `ttl` seconds is served from the disk. Older pages
+    are revalidated with their ETag and Last-Modified headers, so the body is
+    only downloaded again when the server has a new version.
+
+    Args:
+        path (str, optional): Directory where the pages are stored
+
+        ttl (int, optional): Seconds during which a page is used without
+            asking the server. 0 revalidates every page.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=0):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(self.path, exist_ok=True)
+
+    def _paths(self, url):
+        key = os.path.join(self.path, hashlib.sha1(url.encode('utf8')).hexdigest())
+        return key + '.json', key + '.body'
+
+    def get(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf8') as in_f:
+                meta = json.load(in_f)
+            with open(body_path, 'rb') as in_f:
+                return meta, in_f.read()
+        except (IOError, ValueError):
+            return None, None
+
+    def put(self, url, meta, content=None):
+        meta_path, body_path = self._paths(url)
+        if content is not None:
+            with open(body_path + '.tmp', 'wb') as out_f:
+                out_f.write(content)
+            os.replace(body_path + '.tmp', body_path)
+        with open(meta_path + '.tmp', 'w', encoding='utf8') as out_f:
+            json.dump(meta, out_f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def fetch(self, url, session=session, **kwargs):
+        """Get the content of a page, from the disk when it is still valid"""
+        meta, content = self.get(url)
+        if meta and time.time() - meta['fetched_at'] < self.ttl:
+            return content
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        page = session.get(url, headers=headers, **kwargs)
+        if meta and page.status_code == 304:
+            meta['fetched_at'] = time.time()
+            self.put(url, meta)
+            return content
+
+        if page.status_code == 200:
+            self.put(url, {
+                  'url': url
+                , 'etag': page.headers.get('ETag')
+                , 'last_modified': page.headers.get('Last-Modified')
+                , 'fetched_at': time.time()
+            }, page.content)
+
+        return page.content
+
+def fetch(url, session=session, cache=None, **kwargs):
+    """Get the content of a page through the pooled session and the cache if any"""
+    if cache:
+        return cache.fetch(url, session=session, **kwargs)
+
+    return session.get(url, **kwargs).content
 
 class Scrapper:
     """Scrapper use extractors and actors against web pages.
@@ -47,9 +150,24 @@ class Scrapper:
         pagination (int, optional): The scrapper run against the `pagination` next pages
             at each iteration.
 
+        session (requests.Session, optional): The session whose connections are
+            reused, the module one by default.
+
+        cache (ResponseCache, optional): Where the pages are cached on disk, they
+            are always downloaded if not given.
+
+        fast (bool, optional): Parse with lxml when it is installed, and download
+            the next page while the extractors run on the current one.
+
+        parse_only (SoupStrainer or str, optional): Only parse the matching parts
+            of the pages. `'auto'` builds it from the css selector extractors, see
+            `strainer_for`; the whole page is parsed when there are function
+            extractors, actors or a next url extractor as they may need any of it.
+
     """
 
-    def __init__(self, url=None, next_url_extractor=None, extractors=[], actors=[], cookies={}, pagination=10, verbose=False):
+    def __init__(self, url=None, next_url_extractor=None, extractors=[], actors=[], cookies={}, pagination=10, verbose=False,
+            session=session, cache=None, fast=False, parse_only=None):
         self.url = url
         self.next_url_extractor = next_url_extractor
         self.extractors = list(map(self.format_extractor, extractors))
@@ -57,6 +175,16 @@ class Scrapper:
         self.cookies = cookies
         self.pagination = pagination
         self.verbose = verbose
+        self.session = session
+        self.cache = cache
+        self.parser = FAST_PARSER if fast else 'html.parser'
+        self.prefetcher = ThreadPoolExecutor(max_workers=1) if fast else None
+        self.prefetched = None
+
+        if parse_only == 'auto':
+            only_selectors = all(isinstance(e, str) for e in extractors) and not actors and not next_url_extractor
+            parse_only = strainer_for(extractors) if only_selectors else None
+        self.parse_only = parse_only
 
     def __iter__(self):
         return self
@@ -82,15 +210,35 @@ class Scrapper:
         if self.verbose:
             print('[scrapper]', url)
         
-        page = requests.get(url, cookies=self.cookies)
-        soup = BeautifulSoup(page.content, 'html.parser')
+        content = self._fetch(url)
+        with stage('scrapper.parse') as parsing:
+            soup = BeautifulSoup(content, self.parser, parse_only=self.parse_only)
+            parsing.count(pages=1, bytes=len(content))
+
+        next_url = self.next_url_extractor and self.next_url_extractor(soup)
+        if next_url and self.prefetcher:
+            self.prefetched = (next_url, self.prefetcher.submit(self._download, next_url))
+
         infos = [extractor(soup) for extractor in self.extractors]
         infos =  list(filter(None.__ne__, infos))
         actors = [actor.feed(soup) for actor in self.actors]
 
-        next_url = self.next_url_extractor and self.next_url_extractor(soup)
         return infos, actors, next_url
 
+    def _download(self, url):
+        with stage('scrapper.fetch') as fetching:
+            content = fetch(url, session=self.session, cache=self.cache, cookies=self.cookies)
+            fetching.count(pages=1, bytes=len(content))
+
+        return content
+
+    def _fetch(self, url):
+        if self.prefetched and self.prefetched[0] == url:
+            future, self.prefetched = self.prefetched[1], None
+            return future.result()
+
+        return self._download(url)
+
     def page(self, url=None):
         infos, actors, next_url = self._page(url)
         for actor in actors:
@@ -111,6 +259,95 @@ class Scrapper:
         
         return func_extractor
 
+download_executor = ThreadPoolExecutor(max_workers=10)
+
+def stream_download(url, filename, session=session, chunk_size=1 << 16):
+    """Download a file by chunks, resuming a partial download if there is one
+
+    The file is written to `filename + '.part'` and renamed once complete.
+    A file already there with the size announced by the server is skipped.
+
+    Returns:
+        The number of bytes downloaded and the time it took, (0, 0) if the
+        file was already complete.
+    """
+    with stage('scrapper.download') as downloading:
+        size, seconds = _stream_download(url, filename, session, chunk_size, downloading)
+        downloading.count(files=1, bytes=size)
+
+    return size, seconds
+
+def _stream_download(url, filename, session, chunk_size, downloading):
+    if os.path.isfile(filename):
+        length = session.head(url, allow_redirects=True).headers.get('Content-Length')
+        if length is None or int(length) == os.path.getsize(filename):
+            downloading.skip('already downloaded')
+            return 0, 0
+
+    part = filename + '.part'
+    start = os.path.getsize(part) if os.path.isfile(part) else 0
+    headers = {'Range': 'bytes={}-'.format(start)} if start else {}
+    begin = time.monotonic()
+    size = 0
+
+    # The responses of requests < 2.18 are not context managers
+    with closing(session.get(url, headers=headers, stream=True)) as response:
+        if response.status_code == 416:
+            # Nothing left past the partial file, complete only if it has the size of the file
+            length = session.head(url, allow_redirects=True).headers.get('Content-Length')
+            if length is not None and int(length) == start:
+                os.replace(part, filename)
+                downloading.skip('already downloaded')
+                return 0, 0
+
+            os.remove(part)
+            return _stream_download(url, filename, session, chunk_size, downloading)
+        response.raise_for_status()
+
+        mode = 'ab' if start and response.status_code == 206 else 'wb'
+        with open(part, mode) as out_f:
+            for chunk in response.iter_content(chunk_size):
+                out_f.write(chunk)
+                size += len(chunk)
+
+    os.replace(part, filename)
+    return size, time.monotonic() - begin
+
+def strainer_for(selectors):
+    """Build a `SoupStrainer` keeping the elements the css selectors start from
+
+    Only the first compound of every selector is looked at: its tag name,
+    or for a single selector its tag name, id and classes. `None` is given
+    back when the selectors can't be narrowed down, meaning a full parse.
+
+    Note:
+        The selectors are then run against the kept elements only, so they
+        must not depend on what is around them (like `nth-of-type`).
+    """
+    compounds = []
+    for selector in selectors:
+        for part in selector.split(','):
+            compound = re.split(r'\s*[\s>+~]\s*', part.strip())[0]
+            match = re.match(r'^([a-zA-Z][\w-]*)?((?:[#.][\w-]+)*)', compound)
+            name, rest = match.group(1), match.group(2)
+            ids = re.findall(r'#([\w-]+)', rest)
+            classes = re.findall(r'\.([\w-]+)', rest)
+            compounds.append((name, ids, classes))
+
+    if len(compounds) == 1:
+        name, ids, classes = compounds[0]
+        attrs = {}
+        if ids:
+            attrs['id'] = ids[0]
+        if classes:
+            attrs['class'] = classes[0]
+        return SoupStrainer(name, attrs=attrs) if name or attrs else None
+
+    if compounds and all(name for name, _, _ in compounds):
+        return SoupStrainer(list({name for name, _, _ in compounds}))
+
+    return None
+
 def extract(url, extractors, *args, **kwargs):
     """Helper function which return the extractors result form one page.
     
@@ -167,18 +404,24 @@ class Object_DL:
         print(template_msg + 'consume ' + url)
         
         try:
-            self.download(url)
+            transfer = self.download(url)
         except Exception as e:
             print(template_msg + 'ERROR:\n{0}'.format(str(e)))
         else:
-            print(template_msg + 'Done')
+            if transfer and transfer[1]:
+                size, seconds = transfer
+                print(template_msg + 'Done ({0:.1f} MB at {1:.1f} MB/s)'.format(size / 1e6, size / 1e6 / seconds))
+            elif transfer:
+                print(template_msg + 'Already downloaded')
+            else:
+                print(template_msg + 'Done')
     
     def consume(self):
         urls = list(filter(None.__ne__, self.urls))
         func = partial(self._consume, str(len(urls)))
 
-        with Pool(10) as p:
-            p.map(func, enumerate(urls))
+        # The downloads are I/O bound, they share the threads of the module
+        list(download_executor.map(func, enumerate(urls)))
 
         self.urls = []
 
@@ -230,4 +473,4 @@ class File_DL (Object_DL):
 
     def download(self, url):
         name = os.path.basename(url)
-        urllib.request.urlretrieve(url, os.path.join(self.path, name))  
+        return stream_download(url, os.path.join(self.path, name))  
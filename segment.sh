@@ -8,7 +8,14 @@ kBest="0"
 BASEDIR=`dirname $0`
 DATADIR=$BASEDIR/data
 # LEXDIR=$DATADIR/lexicons
-JAVACMD="java -mx2g -cp $BASEDIR/*: edu.stanford.nlp.ie.crf.CRFClassifier -sighanCorporaDict $DATADIR -textFiles $files -inputEncoding $enc -sighanPostProcessing true $ARGS"
+# Given `-` as files, the classifier stays up and segments stdin line by line
+if [ "$files" = "-" ]; then
+  INPUT="-readStdin"
+else
+  INPUT="-textFiles $files"
+fi
+
+JAVACMD="java -mx2g -cp $BASEDIR/*: edu.stanford.nlp.ie.crf.CRFClassifier -sighanCorporaDict $DATADIR $INPUT -inputEncoding $enc -outputEncoding $enc -sighanPostProcessing true $ARGS"
 DICTS=$DATADIR/dict-chris6.ser.gz
 KBESTCMD=""
 
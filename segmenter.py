@@ -0,0 +1,430 @@
+import os
+import re
+import sys
+import math
+import atexit
+import socket
+import threading
+import socketserver
+from collections import deque
+from multiprocessing import Pool
+from subprocess import Popen, PIPE, DEVNULL
+
+SEGMENTER_BACKEND = os.environ.get('SEGMENTER_BACKEND', 'stanford')
+SEGMENTER_HOST    = os.environ.get('SEGMENTER_HOST', '127.0.0.1')
+SEGMENTER_PORT    = int(os.environ.get('SEGMENTER_PORT', 9371))
+DICTIONARY_PATH   = os.path.join('data', 'dictionary.txt')
+
+HAN_RE   = re.compile(r'([\u3400-\u4DBF\u4E00-\u9FFF\uF900-\uFAFF]+)')
+OTHER_RE = re.compile(r'[A-Za-z0-9]+|\S')
+
+def read_lines(path):
+    """Read the lines of a document without their line breaks"""
+    with open(path, 'r', encoding='utf8') as in_f:
+        content = in_f.read()
+
+    return content.split('\n')[:-1] if content.endswith('\n') else content.split('\n')
+
+class SegmenterError(Exception):
+    pass
+
+def frame(lines):
+    """Make one line per input line, the segmenter working line by line"""
+    return [line.replace('\r', ' ').replace('\n', ' ').strip() for line in lines]
+
+class StanfordSegmenter:
+    """Long-lived Stanford segmenter.
+
+    The JVM is started once with `segment.sh -` and keeps the classifier and
+    the dictionary loaded, reading lines on stdin and writing one segmented
+    line per line on stdout. Each document is framed by its number of non
+    empty lines: they are written by a feeder thread while exactly as many
+    lines are read back, the empty lines being filled in without a round trip.
+
+    Args:
+        command (list of str, optional): The command starting the segmenter
+    """
+
+    version = 'stanford-pku'
+    parallel = False
+
+    def __init__(self, command=None):
+        self.command = command or ['./segment.sh', '-']
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.process is None or self.process.poll() is not None:
+            self.process = Popen(self.command, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+
+        return self
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+    def kill(self):
+        """Stop the JVM in whatever state it is, the next document starting a new one"""
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            for pipe in (self.process.stdin, self.process.stdout):
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+        self.process = None
+
+    def _feed(self, lines, errors):
+        try:
+            for line in lines:
+                self.process.stdin.write((line + '\n').encode('utf8'))
+            self.process.stdin.flush()
+        except Exception as e:
+            errors.append(e)
+
+    def segment(self, lines):
+        """Segment a document, giving back one segmented line per line
+
+        Raises:
+            SegmenterError: The segmenter died before giving back every
+                line, it is started again for the next document
+        """
+        lines = frame(lines)
+        to_segment = [line for line in lines if line]
+
+        with self.lock:
+            self.start()
+            errors = []
+            feeder = threading.Thread(target=self._feed, args=(to_segment, errors))
+            feeder.start()
+
+            segmented = []
+            for _ in to_segment:
+                line = self.process.stdout.readline()
+                if not line:
+                    break
+                segmented.append(line.decode('utf8').rstrip('\n'))
+            if len(segmented) < len(to_segment):
+                # The feeder is blocked on a full pipe or failing, it stops with the JVM
+                self.kill()
+            feeder.join()
+
+            if errors or len(segmented) < len(to_segment):
+                self.kill()
+                raise SegmenterError('The segmenter stopped after {} of {} lines{}'.format(
+                    len(segmented), len(to_segment), ': {!r}'.format(errors[0]) if errors else '')) \
+                    from (errors[0] if errors else None)
+
+        segmented = iter(segmented)
+        return [next(segmented) if line else '' for line in lines]
+
+class DictionarySegmenter:
+    """Pure Python segmenter driven by a dictionary of word frequencies.
+
+    The Han characters of a line are turned into the DAG of all the
+    dictionary words they contain, and the path maximizing the product of
+    the unigram probabilities is kept. Anything else is split into latin or
+    digit runs and single symbols. There is no start-up cost, so the files
+    can be fanned out across a process pool (see `segment_paths`).
+
+    Args:
+        frequencies (dict): The word -> count dictionary
+    """
+
+    parallel = True
+
+    def __init__(self, frequencies):
+        self.frequencies = {}
+        for word, count in frequencies.items():
+            self.frequencies[word] = count
+            for i in range(1, len(word)):
+                self.frequencies.setdefault(word[:i], 0)
+
+        total = sum(frequencies.values()) or 1
+        self.log_total = math.log(total)
+        self.version = 'dictionary-{}-{}'.format(len(frequencies), total)
+
+    @classmethod
+    def from_corpus(cls, corpus, min_count=2):
+        """Bootstrap the dictionary from the words of the crushed subtitles
+
+        Every variant of a word gets the count of its canonical form, so that
+        simplified and traditional subtitles are cut alike.
+        """
+        counts = corpus.counts.sum(axis=0).A1[corpus.canonical]
+        return cls({word: int(count) for word, count in zip(corpus.variants, counts)
+            if count >= min_count and HAN_RE.fullmatch(word)})
+
+    @classmethod
+    def load(cls, filename=DICTIONARY_PATH):
+        frequencies = {}
+        with open(filename, 'r', encoding='utf8') as in_f:
+            for line in in_f:
+                word, count = line.split()
+                frequencies[word] = int(count)
+
+        return cls(frequencies)
+
+    def save(self, filename=DICTIONARY_PATH):
+        with open(filename, 'w', encoding='utf8') as out_f:
+            for word, count in self.frequencies.items():
+                if count:
+                    out_f.write('{} {}\n'.format(word, count))
+
+    def close(self):
+        pass
+
+    def _cut(self, sentence):
+        n = len(sentence)
+        route = [(0.0, 0)] * (n + 1)
+
+        for start in range(n - 1, -1, -1):
+            best = None
+            end = start + 1
+            fragment = sentence[start]
+            while fragment in self.frequencies:
+                count = self.frequencies[fragment]
+                if count or end == start + 1:
+                    score = math.log(count or 1) - self.log_total + route[end][0]
+                    if best is None or score > best[0]:
+                        best = (score, end)
+                if end >= n:
+                    break
+                end += 1
+                fragment = sentence[start:end]
+            route[start] = best or (route[start + 1][0] - self.log_total, start + 1)
+
+        start = 0
+        while start < n:
+            end = route[start][1]
+            yield sentence[start:end]
+            start = end
+
+    def segment_line(self, line):
+        words = []
+        for i, block in enumerate(HAN_RE.split(line)):
+            if i % 2:
+                words.extend(self._cut(block))
+            else:
+                words.extend(OTHER_RE.findall(block))
+
+        return ' '.join(words)
+
+    def segment(self, lines):
+        """Segment a document, giving back one segmented line per line"""
+        return [self.segment_line(line) for line in frame(lines)]
+
+class SegmenterClient:
+    """Client of a segmenter served by `serve` on a local socket.
+
+    A request is a line with the number of lines of the document followed by
+    these lines, the answer being as many segmented lines.
+    """
+
+    parallel = False
+
+    def __init__(self, host=SEGMENTER_HOST, port=SEGMENTER_PORT):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connect()
+
+    def connect(self):
+        self.connection = socket.create_connection((self.host, self.port))
+        self.stream = self.connection.makefile('rwb')
+        self.version = self.stream.readline().decode('utf8').rstrip('\n')
+        if not self.version:
+            self.close()
+            raise SegmenterError('The segmenter server closed the connection')
+
+    def close(self):
+        if self.connection is not None:
+            for closeable in (self.stream, self.connection):
+                try:
+                    closeable.close()
+                except OSError:
+                    pass
+        self.connection = None
+
+    def segment(self, lines):
+        """Segment a document, giving back one segmented line per line
+
+        Raises:
+            SegmenterError: The connection was lost before every line came
+                back, it is opened again for the next document
+        """
+        lines = frame(lines)
+
+        with self.lock:
+            try:
+                if self.connection is None:
+                    self.connect()
+
+                self.stream.write('{}\n'.format(len(lines)).encode('utf8'))
+                for line in lines:
+                    self.stream.write((line + '\n').encode('utf8'))
+                self.stream.flush()
+
+                segmented = []
+                for _ in lines:
+                    line = self.stream.readline()
+                    if not line:
+                        raise SegmenterError('The segmenter server stopped after {} of {} lines'.format(
+                            len(segmented), len(lines)))
+                    segmented.append(line.decode('utf8').rstrip('\n'))
+            except (OSError, SegmenterError) as e:
+                self.close()
+                if isinstance(e, SegmenterError):
+                    raise
+                raise SegmenterError('The connection to the segmenter server was lost: {}'.format(e)) from e
+
+            return segmented
+
+class SegmenterHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write((self.server.segmenter.version + '\n').encode('utf8'))
+        self.wfile.flush()
+
+        for header in self.rfile:
+            lines = [self.rfile.readline().decode('utf8') for _ in range(int(header))]
+            for line in self.server.segmenter.segment(lines):
+                self.wfile.write((line + '\n').encode('utf8'))
+            self.wfile.flush()
+
+class SegmenterServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, segmenter, host=SEGMENTER_HOST, port=SEGMENTER_PORT):
+        super().__init__((host, port), SegmenterHandler)
+        self.segmenter = segmenter
+
+def serve(host=SEGMENTER_HOST, port=SEGMENTER_PORT):
+    """Keep a segmenter up for the other processes on a local socket"""
+    segmenter = StanfordSegmenter().start()
+    print('> Segmenter listening on {}:{}'.format(host, port))
+
+    server = SegmenterServer(segmenter, host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        segmenter.close()
+
+def load_dictionary_segmenter(filename=DICTIONARY_PATH):
+    """Load the dictionary segmenter, bootstrapping it from the corpus once"""
+    if os.path.isfile(filename):
+        return DictionarySegmenter.load(filename)
+
+    from corpus import load_corpus
+
+    segmenter = DictionarySegmenter.from_corpus(load_corpus())
+    segmenter.save(filename)
+
+    return segmenter
+
+_segmenter = None
+
+def _set_segmenter(segmenter):
+    global _segmenter
+    _segmenter = segmenter
+
+def get_segmenter(backend=None):
+    """Get the segmenter shared by the process
+
+    The backend is `stanford` unless told otherwise by `SEGMENTER_BACKEND`.
+    For `stanford`, a segmenter served on the local socket is used if there
+    is one running, otherwise a JVM is started on first use for the
+    lifetime of the process. `dictionary` is the pure Python
+    `DictionarySegmenter`.
+    """
+    global _segmenter
+    backend = backend or SEGMENTER_BACKEND
+
+    if _segmenter is None:
+        if backend == 'dictionary':
+            _segmenter = load_dictionary_segmenter()
+        elif backend == 'stanford':
+            try:
+                _segmenter = SegmenterClient()
+            except OSError:
+                _segmenter = StanfordSegmenter()
+        else:
+            raise ValueError('Unknown segmenter backend `{}`'.format(backend))
+        atexit.register(_segmenter.close)
+
+    return _segmenter
+
+def _segment_document(document):
+    key, lines = document
+    return key, _segmenter.segment(lines)
+
+def _segment_path(path):
+    return path, _segmenter.segment(read_lines(path))
+
+def bounded_imap(pool, function, iterable, window):
+    """Like `Pool.imap`, with at most `window` items in flight
+
+    `Pool.imap` consumes its whole input up front and queues the results
+    the caller did not take yet, here the input is only read as the results
+    are taken, so memory stays bounded by the window.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+def segment_documents(documents, segmenter=None, processes=None, window=None):
+    """Yield the (key, segmented lines) of (key, lines) documents, in order
+
+    The documents are only pulled from `documents` as they are segmented, so
+    a generator of documents goes through with a bounded memory. They are
+    spread over a process pool when the segmenter runs in process, a worker
+    being forked with the dictionary already loaded, `window` documents
+    (4 per worker by default) being in flight at most.
+    """
+    segmenter = segmenter or get_segmenter()
+
+    processes = processes or os.cpu_count() or 1
+
+    if getattr(segmenter, 'parallel', False) and processes > 1:
+        with Pool(processes, initializer=_set_segmenter, initargs=(segmenter,)) as pool:
+            for result in bounded_imap(pool, _segment_document, documents, window or 4 * processes):
+                yield result
+    else:
+        for key, lines in documents:
+            yield key, segmenter.segment(lines)
+
+def segment_paths(paths, segmenter=None, processes=None):
+    """Yield the (path, segmented lines) of every file, in order
+
+    The files are read by the workers when they are spread over a process
+    pool, see `segment_documents`.
+    """
+    segmenter = segmenter or get_segmenter()
+    processes = processes or os.cpu_count() or 1
+
+    if getattr(segmenter, 'parallel', False) and len(paths) > 1 and processes > 1:
+        with Pool(processes, initializer=_set_segmenter, initargs=(segmenter,)) as pool:
+            for result in bounded_imap(pool, _segment_path, paths, 4 * processes):
+                yield result
+    else:
+        for path in paths:
+            yield path, segmenter.segment(read_lines(path))
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['serve']:
+        serve()
+    else:
+        segmenter = get_segmenter()
+        for line in segmenter.segment(sys.stdin.readlines()):
+            print(line)
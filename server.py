@@ -0,0 +1,370 @@
+import os
+import json
+import time
+import asyncio
+import fnmatch
+import argparse
+from os import path
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import numpy as np
+
+from known_car import get_user_words, add_user_words, canonical_words, is_valid_user, user_exists
+from corpus import CORPUS_PATH, WORD_INDEX_PATH, Corpus, WordIndex
+from compare import MANIFEST_PATH
+from scores import load_user_scores
+from store import STORE_PATH, CorpusStore
+
+SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 8371))
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class LRUCache:
+    """Least recently used cache of the answers, keyed by (user, query)"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user=None):
+        """Forget the answers of a user, or all of them"""
+        if user is None:
+            self.entries.clear()
+        else:
+            for key in [key for key in self.entries if key[0] == user]:
+                del self.entries[key]
+
+def published_at():
+    """The time of the last crush, `compare.crush_subtitles` writing the manifest last"""
+    return path.getmtime(MANIFEST_PATH) if path.exists(MANIFEST_PATH) else 0
+
+class Snapshot:
+    """The corpus, the word index and the store loaded together
+
+    The files are only read, never built again or saved, the server leaving
+    them to `compare.crush_subtitles`.
+    """
+
+    def __init__(self):
+        self.loaded_at = time.time()
+        self.published_at = published_at()
+        self.corpus = Corpus.load(CORPUS_PATH)
+        self.store = CorpusStore(STORE_PATH) if path.isfile(STORE_PATH) else None
+        self.index = WordIndex.load(self.corpus, WORD_INDEX_PATH, store=self.store)
+        self.names = self.corpus.names
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+class QueryService:
+    """The queries answered by the server, on a corpus kept in memory
+
+    The vocabularies and the scores of the users are loaded on their first
+    query and updated in place when words are added. The answers are kept in
+    an LRU cache until the words of their user change or the corpus is
+    reloaded. `handle` takes and gives plain values, so the service can be
+    queried without any socket.
+
+    Args:
+        cache_size (int, optional): The number of answers kept
+    """
+
+    def __init__(self, cache_size=1024):
+        self.snapshot = Snapshot()
+        self.users = {}
+        self.cache = LRUCache(cache_size)
+
+    def reload(self, snapshot):
+        """Swap in a freshly loaded corpus"""
+        former, self.snapshot = self.snapshot, snapshot
+        self.users = {}
+        self.cache.invalidate()
+        former.close()
+
+    def scores(self, user):
+        if user not in self.users:
+            # Reading never registers a user, only adding words does
+            if not user_exists(user):
+                raise HTTPError(404, 'No user named `{}`'.format(user))
+            user_words = get_user_words(user)
+            self.users[user] = load_user_scores(user, user_words, self.snapshot.corpus)
+
+        return self.users[user]
+
+    def ranking(self, user, n=10, path_re='*'):
+        if path_re == '*':
+            return self.scores(user).ranking(n)
+
+        ranking = [movie for movie in self.scores(user).ranking() if fnmatch.fnmatch(movie['name'], path_re)]
+        return ranking[:n] if n > 0 else ranking
+
+    def vocabulary(self, user, movie, n=10):
+        """The most frequent words of a movie the user does not know"""
+        corpus = self.snapshot.corpus
+        try:
+            row = corpus.find(movie)
+        except KeyError as e:
+            raise HTTPError(404, e.args[0])
+
+        start, end = corpus.counts.indptr[row], corpus.counts.indptr[row + 1]
+        words, counts = corpus.counts.indices[start:end], corpus.counts.data[start:end]
+        unknown = ~self.scores(user).known[words]
+        words, counts = words[unknown], counts[unknown]
+        order = np.argsort(-counts, kind='stable')[:n]
+
+        return [(corpus.words[w], int(c)) for w, c in zip(words[order].tolist(), counts[order].tolist())]
+
+    def examples(self, user, word, movie='*', n=20):
+        """Lines containing a word, with the words of the lines the user does not know"""
+        corpus = self.snapshot.corpus
+        known = self.scores(user).known
+        examples = []
+
+        for file_name, line in self.snapshot.index.examples(word, movie):
+            unknown = [w for w in line.split(' ') if w in corpus.vocabulary and not known[corpus.vocabulary[w]]]
+            examples.append({'movie': file_name, 'line': line, 'unknown': unknown})
+            if len(examples) == n:
+                break
+
+        return examples
+
+    def add_words(self, user, words, source=None):
+        new_words = add_user_words(user, words, source=source, corpus=self.snapshot.corpus)
+        if user in self.users:
+            self.users[user].add_words(canonical_words(new_words))
+        self.cache.invalidate(user)
+
+        return sorted(new_words)
+
+    def status(self):
+        snapshot = self.snapshot
+        return {
+              'movies': len(snapshot.corpus)
+            , 'words': len(snapshot.corpus.words)
+            , 'signature': snapshot.corpus.signature
+            , 'loaded_at': snapshot.loaded_at
+            , 'users': sorted(self.users)
+            , 'cache': {'size': len(self.cache.entries), 'hits': self.cache.hits, 'misses': self.cache.misses}
+        }
+
+    def handle(self, method, target, body=b''):
+        """Answer a request, giving back the status and the JSON body
+
+        The answers are cached encoded, a cache hit being sent as it is.
+
+        GET  /status
+        GET  /users/<user>/ranking?n=10&path_re=*
+        GET  /users/<user>/vocabulary?movie=<name>&n=10
+        GET  /users/<user>/examples?word=<word>&movie=*&n=20
+        POST /users/<user>/words         {"words": [...], "source": "..."}
+        """
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            if parts == ['status']:
+                return 200, encode(self.status())
+
+            if len(parts) != 3 or parts[0] != 'users':
+                raise HTTPError(404, 'No such endpoint `{}`'.format(url.path))
+            user, endpoint = parts[1], parts[2]
+            if not is_valid_user(user):
+                raise HTTPError(400, 'User names are letters, digits, `_` and `-` only')
+
+            if endpoint == 'words':
+                if method != 'POST':
+                    raise HTTPError(405, 'Words are added with a POST')
+                words, source = parse_words(body)
+                return 200, encode({'user': user, 'new_words': self.add_words(user, words, source)})
+
+            if method != 'GET':
+                raise HTTPError(405, 'The {} endpoint is read with a GET'.format(endpoint))
+
+            key = (user, endpoint, tuple(sorted(query.items())))
+            answer = self.cache.get(key)
+            if answer is None:
+                answer = encode(self.query(user, endpoint, query))
+                self.cache.put(key, answer)
+
+            return 200, answer
+        except HTTPError as e:
+            return e.status, encode({'error': str(e)})
+
+    def query(self, user, endpoint, query):
+        try:
+            n = int(query.get('n', 10 if endpoint != 'examples' else 20))
+        except ValueError:
+            raise HTTPError(400, '`n` must be an integer')
+
+        if endpoint == 'ranking':
+            return self.ranking(user, n, query.get('path_re', '*'))
+        elif endpoint == 'vocabulary':
+            if 'movie' not in query:
+                raise HTTPError(400, 'The `movie` parameter is missing')
+            return self.vocabulary(user, query['movie'], n)
+        elif endpoint == 'examples':
+            if 'word' not in query:
+                raise HTTPError(400, 'The `word` parameter is missing')
+            return self.examples(user, query['word'], query.get('movie', '*'), n)
+
+        raise HTTPError(404, 'No such endpoint `{}`'.format(endpoint))
+
+async def read_request(reader):
+    """Read a HTTP/1.1 request, None when the client closed the connection"""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+
+    method, target, version = request_line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length', 0))
+    body = await reader.readexactly(length) if length else b''
+    keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+
+    return method, target, body, keep_alive
+
+def parse_words(body):
+    """Get the words and the source of the body of a POST, checked before anything is written"""
+    try:
+        payload = json.loads(body.decode('utf8'))
+    except ValueError:
+        raise HTTPError(400, 'The body must be JSON')
+
+    if not isinstance(payload, dict) or not isinstance(payload.get('words'), list):
+        raise HTTPError(400, 'The body must be a JSON object with a `words` list')
+    if not all(isinstance(word, str) and word for word in payload['words']):
+        raise HTTPError(400, 'The words must be non-empty strings')
+    if not isinstance(payload.get('source'), (str, type(None))):
+        raise HTTPError(400, 'The `source` must be a string')
+
+    return payload['words'], payload.get('source')
+
+def encode(payload):
+    return json.dumps(payload, ensure_ascii=False).encode('utf8')
+
+def write_response(writer, status, body, keep_alive):
+    writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\n'
+        'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+            status, REASONS.get(status, ''), len(body), 'keep-alive' if keep_alive else 'close').encode('latin-1'))
+    writer.write(body)
+
+class Server:
+    """Serve a `QueryService` over HTTP with asyncio
+
+    The queries are answered on the event loop, one at a time, as they only
+    take a few milliseconds on the corpus in memory, adding words being a
+    single small transaction of the users database. The manifest is polled
+    every `reload_interval` seconds, and once `crush_subtitles` wrote it
+    again, a new snapshot is loaded in a thread and swapped in between two
+    requests.
+    """
+
+    def __init__(self, service, host=SERVER_HOST, port=SERVER_PORT, reload_interval=2.0):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.reload_interval = reload_interval
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    write_response(writer, 400, encode({'error': 'Malformed request'}), False)
+                    break
+                if request is None:
+                    break
+
+                method, target, body, keep_alive = request
+                try:
+                    status, body = self.service.handle(method, target, body)
+                except Exception as e:
+                    status, body = 500, encode({'error': '{}: {}'.format(type(e).__name__, e)})
+
+                write_response(writer, status, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def watch(self):
+        loop = asyncio.get_event_loop()
+        failed_at = None
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            # The manifest is written once the crush is over, the other files being complete
+            published = published_at()
+            if published <= self.service.snapshot.published_at or published == failed_at:
+                continue
+
+            print('> Reload the corpus')
+            try:
+                self.service.reload(await loop.run_in_executor(None, Snapshot))
+            except Exception as e:
+                print('> The corpus could not be reloaded: {}'.format(e))
+                failed_at = published
+
+    def run(self):
+        loop = asyncio.get_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self.handle_connection, self.host, self.port))
+        watcher = asyncio.ensure_future(self.watch())
+        print('> Serving {} movies on http://{}:{}'.format(len(self.service.snapshot.corpus), self.host, self.port))
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.cancel()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.service.snapshot.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--cache-size', type=int, default=1024, help='number of answers kept in memory')
+    parser.add_argument('--reload-interval', type=float, default=2.0,
+        help='seconds between two checks of the corpus files')
+    args = parser.parse_args()
+
+    Server(QueryService(args.cache_size), args.host, args.port, args.reload_interval).run()
@@ -0,0 +1,234 @@
+import zlib
+import hashlib
+import argparse
+from os import path
+
+import numpy as np
+
+from corpus import load_corpus
+
+MINHASH_PATH = path.join('data', 'minhash.npz')
+
+# Mersenne prime of the universal hash functions (a * x + b) % p
+PRIME = (1 << 31) - 1
+
+class MinHashIndex:
+    """MinHash signatures of the vocabulary of the movies with an LSH index.
+
+    The signature of a movie is the minimum of `n_hashes` hash functions
+    over its words, two movies having the same minimum with a probability
+    equal to the Jaccard similarity of their vocabularies. Weighted, a word
+    seen c times counts as 1 + log2(c) distinct elements, which estimates
+    a Jaccard similarity weighted by the frequencies instead.
+
+    The signatures are cut in `bands` bands, the movies sharing a whole band
+    being candidates. A query only looks at the movies of its buckets, the
+    candidates being ranked on their exact similarity afterwards.
+
+    The words are hashed from their text, not their id in the corpus, and
+    every signature is kept with a digest of the words it was computed on,
+    so `update` only computes the signatures of the new or changed movies.
+
+    Args:
+        names (list of str): The file names of the movies
+
+        digests (list of str): The digest of the words of every movie
+
+        signatures (numpy.ndarray): The movies x `n_hashes` signatures
+
+        n_hashes, bands (int, optional): `n_hashes` must be a multiple of
+            `bands`. The movies sharing about (1 / bands) ** (bands / n_hashes)
+            of their words have even odds to be candidates, 0.25 by default,
+            the best matches of a subtitle sharing 20 to 35% of its words.
+
+        weighted (bool, optional): Weight the words by their frequency
+
+        seed (int, optional): Seed of the hash functions
+    """
+
+    def __init__(self, names, digests, signatures=None, n_hashes=192, bands=64, weighted=False, seed=0):
+        if n_hashes % bands:
+            raise ValueError('{} hashes can not be cut in {} bands'.format(n_hashes, bands))
+
+        self.names = list(names)
+        self.digests = list(digests)
+        self.signatures = signatures if signatures is not None else np.zeros((0, n_hashes), dtype=np.int64)
+        self.n_hashes = n_hashes
+        self.bands = bands
+        self.weighted = weighted
+        self.seed = seed
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, PRIME, n_hashes).astype(np.int64)
+        self.b = rng.randint(0, PRIME, n_hashes).astype(np.int64)
+        self._index()
+
+    def _index(self):
+        self.rows = {name: i for i, name in enumerate(self.names)}
+        self.buckets = [{} for _ in range(self.bands)]
+        for i in range(len(self.names)):
+            for band, key in enumerate(self._keys(self.signatures[i])):
+                self.buckets[band].setdefault(key, []).append(i)
+
+    def _keys(self, signature):
+        return [band.tobytes() for band in np.split(signature, self.bands)]
+
+    @classmethod
+    def build(cls, corpus, n_hashes=192, bands=64, weighted=False, seed=0):
+        index = cls([], [], None, n_hashes, bands, weighted, seed)
+        index.update(corpus)
+
+        return index
+
+    def elements(self, corpus, row, word_hashes):
+        """Get the hashed elements of a movie, and their digest"""
+        start, end = corpus.counts.indptr[row], corpus.counts.indptr[row + 1]
+        hashes = word_hashes[corpus.counts.indices[start:end]]
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+
+        if not self.weighted:
+            return hashes, hashlib.sha1(hashes.tobytes()).hexdigest()
+
+        copies = 1 + np.log2(corpus.counts.data[start:end][order]).astype(np.int64)
+        copy = np.arange(copies.sum()) - np.repeat(np.cumsum(copies) - copies, copies)
+        elements = (np.repeat(hashes, copies) * 2654435761 + copy) % PRIME
+
+        return elements, hashlib.sha1(hashes.tobytes() + copies.tobytes()).hexdigest()
+
+    def signature(self, elements):
+        if not len(elements):
+            return np.full(self.n_hashes, PRIME, dtype=np.int64)
+
+        return ((self.a[:, None] * elements[None, :] + self.b[:, None]) % PRIME).min(axis=1)
+
+    def update(self, corpus):
+        """Follow the movies of a new build of the corpus
+
+        The signatures of the movies whose words did not change are kept,
+        the other ones are computed, and the removed movies are dropped.
+
+        Returns:
+            The number of signatures computed
+        """
+        word_hashes = np.array([zlib.crc32(word.encode('utf8')) % PRIME for word in corpus.words], dtype=np.int64)
+        signatures = np.empty((len(corpus.files), self.n_hashes), dtype=np.int64)
+        digests = []
+        computed = 0
+
+        for row, name in enumerate(corpus.files):
+            elements, digest = self.elements(corpus, row, word_hashes)
+            former = self.rows.get(name)
+            if former is not None and self.digests[former] == digest:
+                signatures[row] = self.signatures[former]
+            else:
+                signatures[row] = self.signature(elements)
+                computed += 1
+            digests.append(digest)
+
+        self.names, self.digests, self.signatures = list(corpus.files), digests, signatures
+        self._index()
+
+        return computed
+
+    def save(self, filename=MINHASH_PATH):
+        np.savez(filename,
+            names=np.array(self.names, dtype=str),
+            digests=np.array(self.digests, dtype=str),
+            signatures=self.signatures,
+            params=np.array([self.n_hashes, self.bands, int(self.weighted), self.seed]))
+
+    @classmethod
+    def load(cls, filename=MINHASH_PATH):
+        with np.load(filename, allow_pickle=False) as archive:
+            n_hashes, bands, weighted, seed = archive['params'].tolist()
+            return cls(archive['names'].tolist(), archive['digests'].tolist(), archive['signatures'],
+                n_hashes, bands, bool(weighted), seed)
+
+    def candidates(self, name):
+        """Get the rows of the movies sharing at least one band with a movie"""
+        row = self.rows[name]
+        candidates = set()
+        for band, key in enumerate(self._keys(self.signatures[row])):
+            candidates.update(self.buckets[band].get(key, []))
+        candidates.discard(row)
+
+        return sorted(candidates)
+
+    def similar(self, corpus, name, n=10, measure='jaccard'):
+        """Get the movies whose vocabulary is the closest to the one of a movie
+
+        The LSH candidates are ranked on their exact Jaccard similarity
+        (shared words over words of either movie) or on the cosine of
+        their word counts. The MinHash estimate is given along. The index
+        must be up to date with the corpus, see `update`.
+        """
+        if self.names != corpus.files:
+            raise ValueError('The index is not the one of the corpus, it must be updated')
+
+        row = corpus.find(name)
+        rows = np.array(self.candidates(corpus.files[row]), dtype=np.int64)
+        if not len(rows):
+            return []
+
+        shared = np.asarray(corpus.presence[rows] @ corpus.presence[row].T.toarray()).ravel()
+        jaccard = shared / (corpus.all_u_count[rows] + corpus.all_u_count[row] - shared)
+
+        counts = corpus.counts[rows].astype(np.float64)
+        target = corpus.counts[row].astype(np.float64)
+        norms = np.sqrt(np.asarray(counts.multiply(counts).sum(axis=1)).ravel()) * np.sqrt(target.multiply(target).sum())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosine = np.nan_to_num(np.asarray(counts @ target.T.toarray()).ravel() / norms)
+
+        estimate = (self.signatures[rows] == self.signatures[row]).mean(axis=1)
+        order = np.argsort(-(jaccard if measure == 'jaccard' else cosine), kind='stable')[:n]
+        names = corpus.names
+
+        return [{
+              'name': names[rows[j]]
+            , 'jaccard': float(jaccard[j])
+            , 'cosine': float(cosine[j])
+            , 'estimate': float(estimate[j])
+        } for j in order]
+
+def update_minhash_index(corpus, filename=MINHASH_PATH, **params):
+    """Bring the index in line with the corpus, computing the changed movies only"""
+    index = None
+    if path.isfile(filename):
+        index = MinHashIndex.load(filename)
+        if any(getattr(index, param) != value for param, value in params.items()):
+            index = None
+
+    if index is None:
+        index = MinHashIndex([], [], **params)
+
+    names = index.names
+    if index.update(corpus) or names != index.names:
+        index.save(filename)
+
+    return index
+
+def load_minhash_index(corpus, filename=MINHASH_PATH, **params):
+    """Load the index, updating it if it is not the one of the corpus"""
+    if path.isfile(filename):
+        index = MinHashIndex.load(filename)
+        if index.names == corpus.files and all(getattr(index, param) == value for param, value in params.items()):
+            return index
+
+    return update_minhash_index(corpus, filename, **params)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find the movies whose vocabulary is like the one of a movie')
+    parser.add_argument('movie', help='crushed file name of the movie, with or without extension')
+    parser.add_argument('-n', type=int, default=10, help='number of movies to show')
+    parser.add_argument('--cosine', action='store_true', help='rank on the cosine of the word counts')
+    parser.add_argument('--weighted', action='store_const', const=True,
+        help='build the signatures again, weighting the words by their frequency')
+    parser.add_argument('--unweighted', action='store_const', const=False, dest='weighted',
+        help='build the signatures again, every word counting once')
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    index = load_minhash_index(corpus, **({} if args.weighted is None else {'weighted': args.weighted}))
+    for movie in index.similar(corpus, args.movie, args.n, 'cosine' if args.cosine else 'jaccard'):
+        print('>  {:.2f} jaccard  {:.2f} cosine:\t{}'.format(movie['jaccard'], movie['cosine'], movie['name']))
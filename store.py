@@ -0,0 +1,245 @@
+import os
+import mmap
+import glob
+import struct
+from os import path
+
+import numpy as np
+
+from corpus import SEGMENTED_SUBTITLES_PATH
+
+STORE_PATH = path.join('data', 'corpus.pack')
+
+MAGIC         = b'CORPACK1'
+RECORD_HEADER = struct.Struct('<4s4xQ')
+MOVIE_HEADER  = struct.Struct('<IIII')
+
+WORDS  = b'WRDS'
+MOVIE  = b'MOVI'
+DELETE = b'DELE'
+
+def padding(length, alignment=8):
+    return -length % alignment
+
+def pack_words(words):
+    # Words are length-prefixed, subtitles containing about any character
+    encoded = [word.encode('utf8') for word in words]
+    lengths = np.array([len(word) for word in encoded], dtype=np.uint32)
+    return b''.join([struct.pack('<I', len(encoded)), lengths.tobytes()] + encoded)
+
+def unpack_words(buffer, start):
+    count = struct.unpack_from('<I', buffer, start)[0]
+    lengths = np.frombuffer(buffer, dtype=np.uint32, count=count, offset=start + 4)
+    position = start + 4 + 4 * count
+    for length in lengths.tolist():
+        yield bytes(buffer[position:position + length]).decode('utf8')
+        position += length
+
+class CorpusStore:
+    """Single-file, append-only store of the segmented subtitles.
+
+    The file is a sequence of records: words records extending the string
+    table, movie records and deletion records. A movie record holds, as
+    int32 arrays, the ids and counts of its words (its crushed dict) and
+    the token ids of every line with the offsets of the lines. The file is
+    memory-mapped and the arrays are views on the map, so opening the store
+    only walks the record headers and decodes the string table.
+
+    A movie appended again replaces the former record, which stays in the
+    file until `compact` rewrites it.
+
+    Args:
+        filename (str, optional): The store file, created if missing
+    """
+
+    def __init__(self, filename=STORE_PATH):
+        self.filename = filename
+        if not path.isfile(filename):
+            with open(filename, 'wb') as out_f:
+                out_f.write(MAGIC)
+
+        self.words = []
+        self.vocabulary = {}
+        self.movies = {}
+        self.map = None
+        self.size = 0
+        self.words_size = 0
+        self._views = {}
+        self._read()
+
+    def _read(self):
+        with open(self.filename, 'rb') as in_f:
+            if in_f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a corpus store'.format(self.filename))
+            size = os.fstat(in_f.fileno()).st_size
+            # The former map stays alive as long as arrays are viewing it
+            self.map = mmap.mmap(in_f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = {}
+
+        # Only the records appended since the last read are walked through
+        position = self.size or len(MAGIC)
+        while position < size:
+            kind, length = RECORD_HEADER.unpack_from(self.map, position)
+            start = position + RECORD_HEADER.size
+
+            if kind == WORDS:
+                self.words_size += RECORD_HEADER.size + length + padding(length)
+                for word in unpack_words(self.map, start):
+                    self.vocabulary[word] = len(self.words)
+                    self.words.append(word)
+            elif kind == MOVIE:
+                name_length = MOVIE_HEADER.unpack_from(self.map, start)[0]
+                name_start = start + MOVIE_HEADER.size
+                self.movies[bytes(self.map[name_start:name_start + name_length]).decode('utf8')] = start
+            elif kind == DELETE:
+                self.movies.pop(bytes(self.map[start:start + length]).decode('utf8'), None)
+
+            position = start + length + padding(length)
+
+        self.size = size
+
+    def _append(self, kind, payload):
+        with open(self.filename, 'ab') as out_f:
+            out_f.write(RECORD_HEADER.pack(kind, len(payload)))
+            out_f.write(payload)
+            out_f.write(b'\0' * padding(len(payload)))
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass
+            self.map = None
+            self._views = {}
+
+    def __len__(self):
+        return len(self.movies)
+
+    def __contains__(self, name):
+        return name in self.movies
+
+    @property
+    def names(self):
+        return sorted(self.movies)
+
+    def append(self, name, lines):
+        """Add or replace a movie from its segmented lines"""
+        new_words = {}
+        tokens = []
+        line_indptr = [0]
+
+        for line in lines:
+            for word in line.split(' '):
+                word_id = self.vocabulary.get(word)
+                if word_id is None:
+                    word_id = new_words.get(word)
+                    if word_id is None:
+                        word_id = new_words[word] = len(self.words) + len(new_words)
+                tokens.append(word_id)
+            line_indptr.append(len(tokens))
+
+        if new_words:
+            self._append(WORDS, pack_words(new_words))
+
+        tokens = np.array(tokens, dtype=np.int32)
+        word_ids, counts = np.unique(tokens, return_counts=True)
+        name_bytes = name.encode('utf8')
+
+        payload = b''.join([
+            MOVIE_HEADER.pack(len(name_bytes), len(word_ids), len(line_indptr) - 1, len(tokens)),
+            name_bytes, b'\0' * padding(len(name_bytes), 4),
+            word_ids.astype(np.int32).tobytes(),
+            counts.astype(np.int32).tobytes(),
+            np.array(line_indptr, dtype=np.int32).tobytes(),
+            tokens.tobytes()])
+        self._append(MOVIE, payload)
+        self._read()
+
+    def delete(self, name):
+        if name in self.movies:
+            self._append(DELETE, name.encode('utf8'))
+            self._read()
+
+    def _arrays(self, name):
+        start = self.movies[name]
+        if start in self._views:
+            return self._views[start]
+
+        name_length, n_unique, n_lines, n_tokens = MOVIE_HEADER.unpack_from(self.map, start)
+        offset = start + MOVIE_HEADER.size + name_length + padding(name_length, 4)
+
+        arrays = []
+        for count in (n_unique, n_unique, n_lines + 1, n_tokens):
+            arrays.append(np.frombuffer(self.map, dtype=np.int32, count=count, offset=offset))
+            offset += 4 * count
+
+        self._views[start] = arrays
+        return arrays
+
+    def counts(self, name):
+        """Get the word ids and counts of a movie, its crushed dict"""
+        word_ids, counts, _, _ = self._arrays(name)
+        return word_ids, counts
+
+    def lines(self, name):
+        """Get the line offsets and the token ids of a movie"""
+        _, _, line_indptr, tokens = self._arrays(name)
+        return line_indptr, tokens
+
+    def line(self, name, number):
+        """Get a segmented line back as text"""
+        line_indptr, tokens = self.lines(name)
+        start, end = line_indptr[number:number + 2].tolist()
+        return ' '.join([self.words[t] for t in tokens[start:end].tolist()])
+
+    @property
+    def dead_fraction(self):
+        """The part of the file taken by replaced and deleted movies, `compact` dropping them"""
+        live = len(MAGIC) + self.words_size
+        for start in self.movies.values():
+            length = RECORD_HEADER.unpack_from(self.map, start - RECORD_HEADER.size)[1]
+            live += RECORD_HEADER.size + length + padding(length)
+
+        return 1 - live / self.size if self.size else 0.0
+
+    def compact(self):
+        """Rewrite the store without the replaced and deleted movie records"""
+        compacted = CorpusStore(self.filename + '.compact')
+        compacted._append(WORDS, pack_words(self.words))
+        for name in self.names:
+            start = self.movies[name]
+            kind, length = RECORD_HEADER.unpack_from(self.map, start - RECORD_HEADER.size)
+            compacted._append(MOVIE, bytes(self.map[start:start + length]))
+        compacted.close()
+
+        self.close()
+        os.replace(self.filename + '.compact', self.filename)
+        self.__init__(self.filename)
+
+    @classmethod
+    def from_segmented(cls, segmented_path=SEGMENTED_SUBTITLES_PATH, filename=STORE_PATH):
+        """Pack the segmented subtitles of a directory into a new store"""
+        if path.isfile(filename):
+            os.remove(filename)
+
+        store = cls(filename)
+        for segmented in sorted(glob.glob(path.join(segmented_path, '*'))):
+            try:
+                with open(segmented, 'r', encoding='utf8') as in_f:
+                    content = in_f.read()
+            except UnicodeDecodeError:
+                print('{} is not in utf-8, it is not packed'.format(path.split(segmented)[1]))
+                continue
+            content = content[:-1] if content.endswith('\n') else content
+            lines = content.split('\n') if content else []
+            store.append(path.split(segmented)[1], lines)
+
+        return store
+
+def load_store(filename=STORE_PATH, segmented_path=SEGMENTED_SUBTITLES_PATH):
+    """Open the corpus store, packing the segmented subtitles the first time"""
+    if path.isfile(filename):
+        return CorpusStore(filename)
+
+    return CorpusStore.from_segmented(segmented_path, filename)
@@ -0,0 +1,126 @@
+import argparse
+
+import numpy as np
+
+from corpus import load_corpus
+from known_car import get_user_words
+from segmenter import HAN_RE
+
+def ranges(starts, ends):
+    """Concatenate the ranges [start, end) in one array"""
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+def study_list(user_words, corpus=None, k=50, threshold=95, path_re='*'):
+    """Find the unknown words pushing the most movies past a known token threshold
+
+    A movie is understood once `threshold` percent of its tokens are known,
+    like the `percentage_similar` of `compare.get_compatibility_subtitle`.
+    Each movie still needs some tokens, and a word brings a movie
+    min(count, needed) / needed of the way, 1 when it alone pushes it past
+    the threshold. The word bringing the most over all the movies is taken,
+    again and again, and only the movies containing it are scored again.
+
+    Only the movies that `k` words could push past the threshold, counting
+    their `k` most frequent unknown words, are looked at, unless none can be.
+    Only the words with Chinese characters are proposed, the punctuation
+    and the latin words still counting as tokens to know.
+
+    Args:
+        user_words (set): The words known by the user
+
+        k (int, optional): The number of words to learn
+
+        threshold (int, optional): The percentage of known tokens a movie
+            is understood from
+
+        path_re (str, optional): The crushed subtitles to consider
+
+    Returns:
+        The words in the order they were picked with the number of movies
+        understood once each is learned, and the number of movies
+        understood before learning any.
+    """
+    corpus = corpus or load_corpus()
+    known = corpus.known_mask(user_words)
+    rows = corpus.select(path_re)
+    rows = rows[corpus.all_count[rows] > 0]
+
+    similar_count, _ = corpus.similar_counts(known)
+    needed = np.ceil(corpus.all_count[rows] * threshold / 100).astype(np.int64) - similar_count[rows]
+    understood = understood_before = int((needed <= 0).sum())
+
+    # The unknown words of the movies still to understand, as movies x words
+    counts = corpus.counts[rows[needed > 0]]
+    needed = needed[needed > 0]
+    counts.data[known[counts.indices]] = 0
+    counts.eliminate_zeros()
+
+    reach = np.array([np.sort(counts.data[s:e])[-k:].sum() for s, e in zip(counts.indptr[:-1], counts.indptr[1:])],
+        dtype=np.int64)
+    if (reach >= needed).any():
+        counts, needed = counts[reach >= needed], needed[reach >= needed]
+
+    movies = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    by_word = counts.tocsc()
+    learnable = np.array([bool(HAN_RE.search(word)) for word in corpus.words])
+
+    def progress(nnz=None):
+        # What the words of the movies bring them, all the movies if `nnz` is None
+        remaining = np.maximum(needed, 0).astype(np.float64)[movies if nnz is None else movies[nnz]]
+        brought = np.minimum(counts.data if nnz is None else counts.data[nnz], remaining)
+        brought /= np.maximum(remaining, 1)
+        return brought
+
+    contributions = progress()
+    scores = np.bincount(counts.indices, weights=contributions, minlength=len(corpus.words))
+
+    words = []
+    token_frequency = corpus.token_frequency
+    document_frequency = corpus.document_frequency
+    while len(words) < k:
+        word = int(np.argmax(scores * learnable))
+        if scores[word] <= 0:
+            break
+
+        word_movies = by_word.indices[by_word.indptr[word]:by_word.indptr[word + 1]]
+        brought = by_word.data[by_word.indptr[word]:by_word.indptr[word + 1]]
+
+        was_needed = needed[word_movies] > 0
+        needed[word_movies] -= brought
+        understood += int((was_needed & (needed[word_movies] <= 0)).sum())
+
+        # Score again the words of the movies containing the word only, or
+        # all of them at once when the word is in most of the movies
+        if len(word_movies) > counts.shape[0] // 4:
+            contributions = progress()
+            scores = np.bincount(counts.indices, weights=contributions, minlength=len(corpus.words))
+        else:
+            nnz = ranges(counts.indptr[word_movies], counts.indptr[word_movies + 1])
+            updated = progress(nnz)
+            scores += np.bincount(counts.indices[nnz], weights=updated - contributions[nnz], minlength=len(corpus.words))
+            contributions[nnz] = updated
+        learnable[word] = False
+
+        words.append({
+              'word': corpus.words[word]
+            , 'understood': understood
+            , 'documents': int(document_frequency[word])
+            , 'tokens': int(token_frequency[word])
+        })
+
+    return words, understood_before
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Words to learn to understand the most movies')
+    parser.add_argument('user')
+    parser.add_argument('-k', type=int, default=50, help='number of words to learn')
+    parser.add_argument('--threshold', type=int, default=95, help='percentage of known tokens to understand a movie')
+    parser.add_argument('--path-re', default='*', help='crushed subtitles to consider')
+    args = parser.parse_args()
+
+    words, understood = study_list(get_user_words(args.user), k=args.k, threshold=args.threshold, path_re=args.path_re)
+    print('> {} movies understood at {}%'.format(understood, args.threshold))
+    for word in words:
+        print('>  {}\t{} movies\t(in {} movies, {} times)'.format(
+            word['word'], word['understood'], word['documents'], word['tokens']))